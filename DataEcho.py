@@ -0,0 +1,127 @@
+import math
+import threading
+import time
+import numpy as np
+
+class DataEcho(object):
+    """
+    This class provides the pool of an ImageReader's echoing mode ("data echoing"): when reading and
+    decoding images is the bottleneck, each decoded source image is kept in a bounded pool and handed out
+    'factor' times before it is evicted. Every time, it goes through the transformations afresh, so each
+    echo is a differently augmented variant of the same image. Echoes are drawn at random from the pool,
+    so the variants of one image are spread out instead of following each other.
+    Echoing trades unique images for throughput: with factor K, only 1 in K samples needs a read.
+
+    Parameters
+    ----------
+    factor: default = 2
+          Number of times each decoded image is handed out, or 'auto' to adapt it to the measured rates:
+          the factor is then the smallest one for which the read and decode time per sample (divided by the
+          factor) is at most the compute time per sample, i.e. the time spent transforming the image and by
+          the caller between two samples, and at most 'max_factor'.
+
+    pool_size: default = 32
+          Maximum number of decoded images held. Memory grows with pool_size times the decoded image size.
+
+    max_factor: default = 8
+          Upper bound of the factor with factor='auto'
+
+    smoothing: default = 0.1
+          Weight of the latest measurement in the moving averages of the read and compute times
+
+    Example Usage:
+    imr = ImageReader(PATH_TO_IMAGES, transforms=tfms, echo=DataEcho(factor='auto', pool_size=64))
+    batch = imr.read_batch_random(64)
+    imr.echo.stats()   # unique_ratio, images_per_s, factor, ...
+    """
+    def __init__(self, factor=2, pool_size=32, max_factor=8, smoothing=0.1):
+        assert factor == 'auto' or factor >= 1
+        self.adaptive = factor == 'auto'
+        self.factor = 1 if self.adaptive else int(factor)
+        self.pool_size = max(int(pool_size), 1)
+        self.max_factor = max(int(max_factor), 1)
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Empties the pool and resets the statistics"""
+        self._pool = []
+        self.emitted = 0
+        self.reads = 0
+        self.read_time = None
+        self.compute_time = None
+        self._start = None
+        self._last = None
+
+    def __getstate__(self):
+        # each process gets its own empty pool
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_pool'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pool)
+
+    def average(self, current, value):
+        return value if current is None else current + self.smoothing * (value - current)
+
+    def update_factor(self):
+        """ Function to set the factor from the measured read and compute times (with factor='auto')"""
+        if not self.adaptive or self.read_time is None:
+            return
+        if not self.compute_time:
+            self.factor = self.max_factor
+            return
+        self.factor = int(min(max(math.ceil(self.read_time / self.compute_time - 1e-9), 1), self.max_factor))
+
+    def take(self, load):
+        """
+        Function to get the next item to hand out. 'load' is called without arguments to read a new item
+        (e.g. an ImageReader decoding a random image), whenever the pool isn't full. Returns the item.
+        The pool is safe to share between threads, and items are loaded without holding its lock.
+        """
+        with self._lock:
+            now = time.perf_counter()
+            if self._start is None:
+                self._start = now
+            if self._last is not None:
+                self.compute_time = self.average(self.compute_time, now - self._last)
+            needed = len(self._pool) < self.pool_size
+        if needed:
+            item = load()
+            duration = time.perf_counter() - now
+        with self._lock:
+            if needed:
+                self.reads += 1
+                self.read_time = self.average(self.read_time, duration)
+                self.update_factor()
+                self._pool.append([item, self.factor])
+            i = np.random.randint(len(self._pool))
+            entry = self._pool[i]
+            entry[1] -= 1
+            if entry[1] <= 0:
+                # swap with the last entry and drop it
+                self._pool[i] = self._pool[-1]
+                self._pool.pop()
+            self.emitted += 1
+            self._last = time.perf_counter()
+            return entry[0]
+
+    def stats(self):
+        """
+        Returns a dict with the number of samples 'emitted' and of images 'read', the 'unique_ratio'
+        (reads per sample), the throughput 'images_per_s' since the first sample, the current 'factor',
+        the moving averages 'read_time' and 'compute_time' (in seconds per image) and the pool size.
+        """
+        elapsed = 0 if self._start is None else self._last - self._start
+        return {'emitted': self.emitted, 'read': self.reads,
+                'unique_ratio': self.reads / self.emitted if self.emitted else 1.0,
+                'images_per_s': self.emitted / elapsed if elapsed > 0 else 0.0,
+                'factor': self.factor, 'read_time': self.read_time, 'compute_time': self.compute_time,
+                'entries': len(self._pool), 'pool_size': self.pool_size}
@@ -0,0 +1,228 @@
+import os
+import collections
+import concurrent.futures as cf
+import numpy as np
+from ImageReader import *
+from SharedBatchRing import *
+
+_worker_reader = None
+_worker_ring = None
+
+def _init_worker(reader, ring=None):
+    """ Initializer for process workers: keep one copy of the reader (and ring) and reseed numpy per process"""
+    global _worker_reader, _worker_ring
+    _worker_reader = reader
+    _worker_ring = ring
+    np.random.seed((os.getpid() * 7919 + int.from_bytes(os.urandom(4), 'little')) % 2**32)
+
+def _load_batch(reader, indices, plan=None, slot=None):
+    """
+    Read the images at 'indices' using 'reader' (or the worker's copy of it), following 'plan' if given.
+    If 'slot' is given, the batch is written into that slot of the worker's ring and (slot, batch size) is returned.
+    """
+    reader = reader if reader is not None else _worker_reader
+    if slot is not None:
+        reader.read_batch(indices, out=_worker_ring.slot(slot)[:len(indices)], plan=plan)
+        return slot, len(indices)
+    if reader.get_output_size() is None:
+        if plan is None:
+            return [reader.read_image_from_idx(idx) for idx in indices]
+        return [reader.read_image_planned(idx, params) for idx, params in zip(indices, plan)]
+    shape, dtype = reader.get_batch_shape(len(indices))
+    return reader.read_batch(indices, out=np.empty(shape, dtype=dtype), plan=plan)
+
+class DataLoader(object):
+    """
+    This class provides iterable instances that read batches of images from an ImageReader
+    in parallel. Each iteration over the instance is one epoch over a shuffled permutation of
+    the reader's file_ids. Reading and transforming images is done by a pool of workers, which
+    keep a bounded number of batches ready ahead of the consumer.
+
+    Parameters
+    ----------
+    reader: An instance of ImageReader
+
+    batch_size: default = 32
+          Number of images in each batch
+
+    num_workers: default = 4
+          Number of threads / processes used to read and transform images
+
+    backend: default = 'thread'
+          'thread' to use a thread pool, 'process' to use a process pool.
+          OpenCV releases the GIL while decoding, so threads are usually enough. Use processes
+          when python-level transforms dominate. With 'process', the reader must be picklable.
+
+    prefetch: default = None
+          Maximum number of batches being read ahead of the consumer.
+          If left to default, 2 * num_workers is used.
+
+    ordered: default = True
+          If set to 'True', batches are returned in permutation order.
+          If set to 'False', batches are returned as soon as they are ready.
+
+    shuffle: default = True
+          If set to 'False', images are read in the order of file_ids.
+          If the reader has a shard (see 'Shard'), each epoch reads this rank's files for that epoch,
+          in the order given by the shard, and 'shuffle' is not used.
+
+    drop_last: default = False
+          If set to 'True', the last incomplete batch of an epoch is dropped
+
+    seed: default = None
+          If left to default, images are shuffled and transformed using the global numpy random state.
+          Optionally, an integer seed. The permutation and the augmentation parameters of every image of
+          epoch e are then sampled up front from seed and e (see 'Transformer.make_epoch_plan': the epoch is
+          split into num_workers contiguous chunks of the permutation, each sampled from its own random
+          stream; batches go to whichever worker is free, so streams aren't tied to workers). An epoch is
+          thus reproducible for a given seed and num_workers, whatever the backend and the order in which
+          workers finish. 'plan' holds the current epoch's plan in permutation order.
+
+    shared_memory: default = False
+          Only used with backend='process' and a reader with a fixed output size. If set to 'True',
+          workers write batches directly into a ring of prefetch + 1 batch slots in shared memory
+          (see 'SharedBatchRing') and only send back slot numbers, instead of pickling every batch.
+          Batches are then views onto the ring, valid until the next batch is requested: a slot is
+          reused once the consumer moves on, so copy a batch to keep it. Call 'close' to release the ring.
+
+    Returns
+    -------
+    An iterable instance. Each batch is an array of shape (N, H, W, C) if the reader has a fixed
+    output size (see 'ImageReader.get_output_size') and a list of images otherwise.
+
+    Example Usage:
+    imr = ImageReader(PATH_TO_IMAGES, transforms=[Horizontal_flip(), Crop_and_resize(sz=(224, 224))])
+    loader = DataLoader(imr, batch_size=64, num_workers=8)
+    for epoch in range(10):
+        for batch in loader:
+            train_step(batch)
+    """
+    def __init__(self, reader, batch_size=32, num_workers=4, backend='thread',
+                 prefetch=None, ordered=True, shuffle=True, drop_last=False, seed=None, shared_memory=False):
+        assert backend in ('thread', 'process')
+        assert batch_size > 0 and num_workers > 0
+        self.reader = reader
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.backend = backend
+        self.prefetch = prefetch if prefetch else 2 * num_workers
+        self.ordered = ordered
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.shared_memory = shared_memory
+        self.epoch = 0
+        self.plan = None
+        self.ring = None
+
+    def get_num_images(self):
+        """ Function to get the number of images read in the current epoch"""
+        if self.reader.shard is None:
+            return self.reader.len
+        return len(self.reader.get_shard_indices(self.epoch))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.get_num_images() // self.batch_size
+        return (self.get_num_images() + self.batch_size - 1) // self.batch_size
+
+    def get_batches(self):
+        """
+        Function to split one epoch's permutation of file indices into batches.
+        Returns a list of (indices, plan) pairs, where plan is None if no seed is set.
+        """
+        n = self.get_num_images()
+        shard = self.reader.shard
+        if shard is not None:
+            self.reader.set_epoch(self.epoch)
+            order = self.reader.get_shard_indices(self.epoch)
+        if self.seed is None:
+            if shard is None:
+                order = np.random.permutation(n) if self.shuffle else np.arange(n)
+            self.plan = None
+        else:
+            # each rank of a shard gets its own augmentation parameters
+            entropy = [self.seed, self.epoch] if shard is None else [self.seed, self.epoch, shard.rank]
+            order_seed, plan_seed = np.random.SeedSequence(entropy).spawn(2)
+            if shard is None:
+                order = np.random.default_rng(order_seed).permutation(n) if self.shuffle else np.arange(n)
+            self.plan = None
+            if self.reader.transform_image:
+                self.plan = self.reader.transform_image.make_epoch_plan(n, plan_seed, self.num_workers)
+        num_batches = n // self.batch_size if self.drop_last else (n + self.batch_size - 1) // self.batch_size
+        starts = range(0, num_batches * self.batch_size, self.batch_size)
+        return [(order[i:i + self.batch_size], None if self.plan is None else self.plan[i:i + self.batch_size])
+                for i in starts]
+
+    def get_ring(self):
+        """ Function to get the shared memory ring of batch slots, or None if batches are pickled"""
+        if not self.shared_memory or self.backend != 'process':
+            return None
+        if self.reader.get_output_size() is None:
+            raise ValueError("shared_memory=True needs a reader with a fixed output size. Add a "
+                             "Crop_and_resize(sz=(width, height)) as the last transform.")
+        shape, dtype = self.reader.get_batch_shape(self.batch_size)
+        if self.ring is None or self.ring.batch_shape != shape or self.ring.dtype != dtype \
+                or len(self.ring) != self.prefetch + 1:
+            self.close()
+            self.ring = SharedBatchRing(self.prefetch + 1, shape, dtype)
+        return self.ring
+
+    def close(self):
+        """ Function to release the shared memory ring, if any"""
+        if self.ring is not None:
+            self.ring.unlink()
+            self.ring = None
+
+    def get_executor(self, ring=None):
+        if self.backend == 'thread':
+            return cf.ThreadPoolExecutor(self.num_workers)
+        return cf.ProcessPoolExecutor(self.num_workers, initializer=_init_worker, initargs=(self.reader, ring))
+
+    def __iter__(self):
+        batches = iter(self.get_batches())
+        # process workers hold their own copy of the reader
+        reader = self.reader if self.backend == 'thread' else None
+        ring = self.get_ring()
+        executor = self.get_executor(ring)
+        pending = collections.deque()
+        # at most prefetch batches are pending and one is held by the consumer, so a slot is always free
+        free = collections.deque(range(len(ring))) if ring is not None else None
+        held = None
+        try:
+            for indices, plan in batches:
+                if ring is None:
+                    pending.append(executor.submit(_load_batch, reader, indices, plan))
+                else:
+                    pending.append(executor.submit(_load_batch, reader, indices, plan, free.popleft()))
+                if len(pending) >= self.prefetch:
+                    batch = self._next_ready(pending)
+                    if ring is not None:
+                        held, batch = self._receive(ring, free, held, batch)
+                    yield batch
+            while pending:
+                batch = self._next_ready(pending)
+                if ring is not None:
+                    held, batch = self._receive(ring, free, held, batch)
+                yield batch
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            # only now, so that len() describes the epoch being read
+            self.epoch += 1
+
+    def _receive(self, ring, free, held, result):
+        """ Recycle the slot of the previous batch and return (slot, view) for the batch in 'result'"""
+        if held is not None:
+            free.append(held)
+        slot, n = result
+        return slot, ring.slot(slot)[:n]
+
+    def _next_ready(self, pending):
+        if self.ordered:
+            return pending.popleft().result()
+        done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+        future = next(f for f in pending if f in done)
+        pending.remove(future)
+        return future.result()
@@ -0,0 +1,244 @@
+import collections
+import hashlib
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+class ImageCache(object):
+    """
+    This class provides a cache of decoded images bounded by the total number of bytes held.
+    When adding an image would exceed 'max_bytes', the least recently used images are evicted.
+    Cached images are marked read-only so that a transformation cannot modify them in place.
+
+    Parameters
+    ----------
+    max_bytes: Maximum total size (in bytes) of the images held in the cache.
+
+    Example Usage:
+    cache = ImageCache(max_bytes=2 * 1024**3)
+    imr = ImageReader(PATH_TO_IMAGES, transforms=tfms, cache=cache)
+    cache.stats()
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        """ Returns the cached (read-only) image for 'key', or None on a miss"""
+        with self._lock:
+            img = self._data.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key, img):
+        """
+        Adds 'img' to the cache and returns the read-only cached array.
+        Images larger than 'max_bytes' are returned without being cached.
+        """
+        img.flags.writeable = False
+        if img.nbytes > self.max_bytes:
+            return img
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self.nbytes + img.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+            self._data[key] = img
+            self.nbytes += img.nbytes
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ Returns a dict with hit / miss / eviction counts and current usage"""
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._data), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+def _key_hash(key):
+    """ Stable 63 bit hash of a cache key, identical across processes"""
+    digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+_ENTRY_DTYPE = np.dtype([('key', np.int64), ('offset', np.int64), ('nbytes', np.int64),
+                         ('shape', np.int32, 3), ('last_used', np.int64)])
+_STATS = ('clock', 'hits', 'misses', 'evictions')
+
+class SharedImageCache(object):
+    """
+    This class provides the same interface as ImageCache, with the images and the cache index
+    held in shared memory so that a single cache can be used by several worker processes
+    (for example the workers of a DataLoader with backend='process').
+    The instance has to be created in the parent process before the workers are started.
+    Images returned by 'get' are copies, since another process may evict and overwrite the
+    underlying memory at any time.
+
+    Parameters
+    ----------
+    max_bytes: Maximum total size (in bytes) of the images held in the cache.
+
+    max_entries: default = 65536
+          Maximum number of images held in the cache.
+
+    Call 'unlink' from the creating process once the cache is no longer needed.
+    """
+    def __init__(self, max_bytes, max_entries=65536):
+        self.max_bytes = int(max_bytes)
+        self.max_entries = int(max_entries)
+        self._owner = True
+        self._lock = mp.Lock()
+        self._data_shm = shared_memory.SharedMemory(create=True, size=max(self.max_bytes, 1))
+        self._index_shm = shared_memory.SharedMemory(
+            create=True, size=_ENTRY_DTYPE.itemsize * self.max_entries + 8 * len(_STATS))
+        self._attach()
+        self._table['key'] = -1
+        self._counters[:] = 0
+
+    def _attach(self):
+        self._data = np.ndarray((self.max_bytes,), dtype=np.uint8, buffer=self._data_shm.buf)
+        self._table = np.ndarray((self.max_entries,), dtype=_ENTRY_DTYPE, buffer=self._index_shm.buf)
+        self._counters = np.ndarray((len(_STATS),), dtype=np.int64, buffer=self._index_shm.buf,
+                                    offset=_ENTRY_DTYPE.itemsize * self.max_entries)
+        self._rows = {}
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes, 'max_entries': self.max_entries, '_lock': self._lock,
+                'data_name': self._data_shm.name, 'index_name': self._index_shm.name}
+
+    def __setstate__(self, state):
+        self.max_bytes = state['max_bytes']
+        self.max_entries = state['max_entries']
+        self._lock = state['_lock']
+        self._owner = False
+        self._data_shm = _open_shared_memory(state['data_name'])
+        self._index_shm = _open_shared_memory(state['index_name'])
+        self._attach()
+
+    def __len__(self):
+        return int((self._table['key'] >= 0).sum())
+
+    def _find(self, key):
+        h = _key_hash(key)
+        row = self._rows.get(h)
+        if row is not None and self._table['key'][row] == h:
+            return row
+        rows = np.flatnonzero(self._table['key'] == h)
+        if len(rows) == 0:
+            return None
+        self._rows[h] = rows[0]
+        return rows[0]
+
+    def _tick(self):
+        self._counters[0] += 1
+        return self._counters[0]
+
+    def get(self, key):
+        """ Returns a copy of the cached image for 'key', or None on a miss"""
+        with self._lock:
+            row = self._find(key)
+            if row is None:
+                self._counters[2] += 1
+                return None
+            self._table['last_used'][row] = self._tick()
+            self._counters[1] += 1
+            start, nbytes, shape = self._table[['offset', 'nbytes', 'shape']][row]
+            return self._data[start:start + nbytes].reshape(tuple(shape)).copy()
+
+    def _allocate(self, nbytes):
+        """ First-fit search for a free range of 'nbytes' between the cached images"""
+        used = np.flatnonzero(self._table['key'] >= 0)
+        order = used[np.argsort(self._table['offset'][used])]
+        starts = self._table['offset'][order]
+        ends = starts + self._table['nbytes'][order]
+        gap_starts = np.concatenate([[0], ends])
+        gap_ends = np.concatenate([starts, [self.max_bytes]])
+        fits = np.flatnonzero(gap_ends - gap_starts >= nbytes)
+        return int(gap_starts[fits[0]]) if len(fits) else None
+
+    def _evict_lru(self):
+        used = np.flatnonzero(self._table['key'] >= 0)
+        row = used[np.argmin(self._table['last_used'][used])]
+        self._table['key'][row] = -1
+        self._counters[3] += 1
+
+    def put(self, key, img):
+        """ Copies 'img' into the cache and returns it. Images larger than 'max_bytes' are not cached."""
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if img.ndim == 1:
+            # compressed file contents, see ImageReader's 'byte_cache'
+            img = img[:, None, None]
+        elif img.ndim == 2:
+            img = img[:, :, None]
+        if img.nbytes > self.max_bytes:
+            return img
+        with self._lock:
+            if self._find(key) is not None:
+                return img
+            offset = self._allocate(img.nbytes)
+            while offset is None or (self._table['key'] >= 0).all():
+                self._evict_lru()
+                offset = self._allocate(img.nbytes)
+            row = np.flatnonzero(self._table['key'] < 0)[0]
+            self._data[offset:offset + img.nbytes] = img.reshape(-1)
+            self._table[row] = (_key_hash(key), offset, img.nbytes, img.shape, self._tick())
+            self._rows[_key_hash(key)] = row
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._table['key'] = -1
+
+    def stats(self):
+        with self._lock:
+            used = self._table['key'] >= 0
+            return {'hits': int(self._counters[1]), 'misses': int(self._counters[2]),
+                    'evictions': int(self._counters[3]), 'entries': int(used.sum()),
+                    'nbytes': int(self._table['nbytes'][used].sum()), 'max_bytes': self.max_bytes}
+
+    def reset_stats(self):
+        with self._lock:
+            self._counters[1:] = 0
+
+    def close(self):
+        self._data = self._table = self._counters = None
+        self._data_shm.close()
+        self._index_shm.close()
+
+    def unlink(self):
+        """ Releases the shared memory. Should only be called by the creating process."""
+        self.close()
+        if self._owner:
+            self._data_shm.unlink()
+            self._index_shm.unlink()
+
+def _open_shared_memory(name):
+    """ Attach to an existing shared memory block created by the parent process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13: child processes share the parent's resource tracker, so registering again is harmless
+        return shared_memory.SharedMemory(name=name)
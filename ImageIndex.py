@@ -0,0 +1,226 @@
+import os
+import hashlib
+import concurrent.futures as cf
+import numpy as np
+from image_header import read_image_size
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.jpe', '.jfif', '.png', '.bmp', '.dib', '.tif', '.tiff', '.webp',
+                  '.ppm', '.pgm', '.pbm', '.pnm', '.jp2', '.exr', '.hdr', '.pic')
+MANIFEST_VERSION = 1
+
+def get_default_manifest(root):
+    """
+    Function to get the default manifest path of a root directory: a file named after a hash of the
+    absolute root path in ~/.cache/image_index (or $XDG_CACHE_HOME/image_index).
+    The manifest is kept out of root, since writing it there would change the modification time of
+    root and force it to be listed again on every run.
+    """
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    digest = hashlib.blake2b(os.path.abspath(root).encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+    return os.path.join(cache, 'image_index', digest + '.npz')
+
+def _pack_strings(strings):
+    """ Store a list of strings as one NUL separated utf-8 blob (file names can't contain NUL)"""
+    return np.frombuffer(b'\0'.join(s.encode('utf-8', 'surrogateescape') for s in strings), dtype=np.uint8)
+
+def _unpack_strings(blob, n):
+    if n == 0:
+        return []
+    return [s.decode('utf-8', 'surrogateescape') for s in blob.tobytes().split(b'\0')]
+
+class _Directory(object):
+    """ Listing of the image files directly inside one directory"""
+    def __init__(self, mtime, names, sizes, mtimes, heights, widths, subdirs):
+        self.mtime = mtime
+        self.names = names
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.heights = heights
+        self.widths = widths
+        self.subdirs = subdirs
+
+class ImageIndex(object):
+    """
+    This class provides an index of the images under a root directory, with the extension,
+    byte size and dimensions of every image, persisted to a manifest file.
+    On the first run, directories are listed with os.scandir (in parallel across subdirectories)
+    and image headers are read to get their dimensions. Later runs load the manifest and only list
+    directories whose modification time changed, and only read headers of new or modified files,
+    so startup time is proportional to what changed rather than to the size of the dataset.
+    Files rewritten in place (which does not change the modification time of their directory)
+    are only picked up once their directory changes; delete the manifest to force a full scan.
+
+    Parameters
+    ----------
+    root: Path to the root directory containing the images
+
+    manifest: default = None
+          Path of the manifest file. If left to default, the manifest is stored in the user's cache
+          directory (see 'get_default_manifest'). Pass False to not persist the index.
+          A manifest inside root changes the modification time of its directory when it is saved,
+          so that directory is listed again on every run.
+
+    recursive: default = True
+          If set to 'True', images in subdirectories are indexed as well. Their IDs are then paths
+          relative to root, such as 'class_a/image_001'.
+
+    num_workers: default = 8
+          Number of threads used to list directories and read image headers
+
+    read_sizes: default = True
+          If set to 'False', image dimensions are not read and are recorded as 0
+
+    Attributes
+    ----------
+    ids: numpy array of image IDs (paths relative to root, without extension)
+    suffixes, sizes, mtimes, heights, widths: numpy arrays with one entry per ID
+
+    Example Usage:
+    index = ImageIndex(PATH_TO_IMAGES)
+    imr = ImageReader(PATH_TO_IMAGES, index=index)
+    """
+    def __init__(self, root, manifest=None, recursive=True, num_workers=8, read_sizes=True):
+        self.root = root
+        self.manifest = get_default_manifest(root) if manifest is None else manifest
+        self.recursive = recursive
+        self.num_workers = num_workers
+        self.read_sizes = read_sizes
+        self.update()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self):
+        """ Function to load the manifest. Returns a dict of relative directory path -> _Directory."""
+        if not self.manifest or not os.path.isfile(self.manifest):
+            return {}
+        try:
+            data = np.load(self.manifest)
+            if int(data['version']) != MANIFEST_VERSION or bool(data['recursive']) != self.recursive \
+                    or bool(data['read_sizes']) != self.read_sizes:
+                return {}
+            dirs = _unpack_strings(data['dirs'], len(data['dir_mtimes']))
+            names = _unpack_strings(data['names'], len(data['sizes']))
+        except (OSError, KeyError, ValueError):
+            return {}
+        starts = data['dir_starts']
+        sizes, mtimes, heights, widths = data['sizes'], data['mtimes'], data['heights'], data['widths']
+        listing = {}
+        for i, d in enumerate(dirs):
+            lo, hi = starts[i], starts[i + 1]
+            listing[d] = _Directory(int(data['dir_mtimes'][i]), names[lo:hi], sizes[lo:hi], mtimes[lo:hi],
+                                    heights[lo:hi], widths[lo:hi], [])
+        for d in dirs:
+            if d:
+                listing[os.path.dirname(d)].subdirs.append(d)
+        return listing
+
+    def save(self, listing):
+        dirs = sorted(listing)
+        counts = [len(listing[d].names) for d in dirs]
+        def concat(attr, dtype):
+            return np.concatenate([getattr(listing[d], attr) for d in dirs] + [np.zeros(0, dtype=dtype)]).astype(dtype)
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest)), exist_ok=True)
+        tmp = self.manifest + '.tmp.npz'
+        np.savez(tmp, version=MANIFEST_VERSION, recursive=self.recursive, read_sizes=self.read_sizes,
+                 dirs=_pack_strings(dirs), dir_mtimes=np.array([listing[d].mtime for d in dirs], dtype=np.int64),
+                 dir_starts=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                 names=_pack_strings([n for d in dirs for n in listing[d].names]),
+                 sizes=concat('sizes', np.int64), mtimes=concat('mtimes', np.int64),
+                 heights=concat('heights', np.int32), widths=concat('widths', np.int32))
+        os.replace(tmp, self.manifest)
+
+    def scan_directory(self, rel, old, mtime):
+        """
+        Function to list one directory, reusing the entries of 'old' for unchanged files.
+        'mtime' is the modification time of the directory, taken before listing it so that files
+        added during the listing are picked up by the next update.
+        """
+        path = os.path.join(self.root, rel)
+        names, sizes, mtimes, subdirs = [], [], [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if self.recursive:
+                        subdirs.append(os.path.join(rel, entry.name))
+                elif os.path.splitext(entry.name)[1].lower() in IMAGE_SUFFIXES:
+                    st = entry.stat()
+                    names.append(entry.name)
+                    sizes.append(st.st_size)
+                    mtimes.append(st.st_mtime_ns)
+        order = np.argsort(names) if names else []
+        names = [names[i] for i in order]
+        sizes = np.array(sizes, dtype=np.int64)[order]
+        mtimes = np.array(mtimes, dtype=np.int64)[order]
+        heights = np.zeros(len(names), dtype=np.int32)
+        widths = np.zeros(len(names), dtype=np.int32)
+        known = {}
+        if old is not None:
+            known = {name: i for i, name in enumerate(old.names)}
+        stale = []
+        for i, name in enumerate(names):
+            j = known.get(name)
+            if j is not None and old.sizes[j] == sizes[i] and old.mtimes[j] == mtimes[i]:
+                heights[i], widths[i] = old.heights[j], old.widths[j]
+            else:
+                stale.append(i)
+        return _Directory(mtime, names, sizes, mtimes, heights, widths, subdirs), stale
+
+    def update(self):
+        """
+        Function to bring the index up to date with the root directory and save the manifest if
+        anything changed. Returns the number of files whose headers were (re)read.
+        """
+        old = self.load()
+        listing, stale_files = {}, []
+        changed = not old
+        with cf.ThreadPoolExecutor(self.num_workers) as executor:
+            def visit(rel):
+                previous = old.get(rel)
+                try:
+                    mtime = os.stat(os.path.join(self.root, rel)).st_mtime_ns
+                except OSError:
+                    return None, []
+                if previous is not None and previous.mtime == mtime:
+                    return previous, []
+                return self.scan_directory(rel, previous, mtime)
+            pending = {executor.submit(visit, ''): ''}
+            while pending:
+                done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+                for future in done:
+                    rel = pending.pop(future)
+                    directory, stale = future.result()
+                    if directory is None:
+                        continue
+                    listing[rel] = directory
+                    if directory is not old.get(rel):
+                        changed = True
+                    stale_files.extend((rel, i) for i in stale)
+                    for sub in directory.subdirs:
+                        pending[executor.submit(visit, sub)] = sub
+            if set(listing) != set(old):
+                changed = True
+            if self.read_sizes and stale_files:
+                paths = [os.path.join(self.root, rel, listing[rel].names[i]) for rel, i in stale_files]
+                for (rel, i), size in zip(stale_files, executor.map(read_image_size, paths, chunksize=64)):
+                    if size is not None:
+                        listing[rel].heights[i], listing[rel].widths[i] = size
+        if changed and self.manifest:
+            self.save(listing)
+        self.set_arrays(listing)
+        return len(stale_files)
+
+    def set_arrays(self, listing):
+        dirs = sorted(listing)
+        paths = [os.path.join(d, n) for d in dirs for n in listing[d].names]
+        split = [os.path.splitext(p) for p in paths]
+        self.ids = np.array([s[0] for s in split], dtype=str)
+        self.suffixes = np.array([s[1] for s in split], dtype=str)
+        def concat(attr, dtype):
+            return np.concatenate([getattr(listing[d], attr) for d in dirs] + [np.zeros(0, dtype=dtype)]).astype(dtype)
+        self.sizes = concat('sizes', np.int64)
+        self.mtimes = concat('mtimes', np.int64)
+        self.heights = concat('heights', np.int32)
+        self.widths = concat('widths', np.int32)
@@ -4,6 +4,16 @@ import matplotlib.pyplot as plt
 import os
 from Transformer import *
 from aug_transforms import *
+from ImageCache import *
+from PackedDataset import *
+from TiledPyramid import *
+from image_header import *
+from ImageIndex import *
+from Profiler import *
+from OutputFormat import *
+from Shard import *
+from DataEcho import *
+import time
 
 class ImageReader(object):
     """
@@ -16,6 +26,12 @@ class ImageReader(object):
     ----------
     root: A Path to the root directory containing all the images.
           Currently, the directory should contain images only. Each image should have the same extension.
+          Alternatively, a directory written by 'pack_images' (see PackedDataset.py), in which case
+          images are read from the memory mapped pixels instead of being decoded.
+          Or a directory written by 'pack_pyramid' (see TiledPyramid.py). The leading geometric
+          transformations (up to the first one without a 'get_affine' method, e.g. flips, rotations and
+          the final Crop_and_resize) are then sampled first, from the size of the image alone, and only
+          the tiles of the coarsest pyramid level with enough resolution for the output are read.
     
     file_ids: default = A list of all file names in the provided directory with extensions removed
           Optionally, a list containing IDs of files can be passed. In this case, the functions read_image_random
@@ -28,21 +44,112 @@ class ImageReader(object):
           
     randomize_transforms: default = False
           Parameter to randomize transformations. See 'Transforms' for more details
+    
+    cache: default = None
+          Optionally, a cache of decoded images. Either an ImageCache / SharedImageCache instance or
+          an integer giving the maximum number of bytes to hold in a new ImageCache.
+          Images are cached before transformations are applied, so augmentation still varies.
+    
+    reduced_decode: default = True
+          If the transformations end with a Crop_and_resize to a fixed size 'sz' that is always applied,
+          and every transformation before it has 'scale_invariant' set, JPEG images much larger than 'sz'
+          are decoded at 1/2, 1/4 or 1/8 of their size with OpenCV's IMREAD_REDUCED_COLOR modes.
+          The factor is the largest one for which the smallest possible crop is still at least 'sz', so
+          images are never upscaled. Fixed crop boxes are scaled to the reduced image.
+          Set to 'False' to always decode images at full resolution.
+    
+    index: default = None
+          If left to default, file names are listed with os.listdir and all images are expected to share
+          the same extension. Optionally, 'True' to index root with an ImageIndex (recursively, with the
+          manifest stored in the user's cache directory), a path to store the ImageIndex manifest at, or
+          an ImageIndex instance.
+          With an index, images can have different extensions and be in subdirectories, and their
+          dimensions are known without reading them.
+    
+    profiler: default = None
+          Optionally, a Profiler instance. The time taken to read and decode each image and by each
+          transformation, the bytes read and how often each transformation fires are then recorded.
+          See 'Profiler'.
+    
+    byte_cache: default = None
+          Optionally, a cache of the compressed file contents. Either an ImageCache / SharedImageCache
+          instance or an integer giving the maximum number of bytes to hold in a new ImageCache.
+          Compressed images are typically 10-20x smaller than decoded ones, so a whole dataset can often
+          be held in memory while images are still decoded and transformed afresh on every read.
+    
+    output: default = None
+          Optionally, an OutputFormat instance converting each transformed image to the dtype, normalization
+          and layout the model consumes, in one pass and directly into the batch (see 'read_batch').
+          If every transformation has 'channel_invariant' set, images are then kept in the BGR order they
+          are decoded in, and the conversion to RGB is folded into the output stage.
+    
+    shard: default = None
+          Optionally, a Shard instance, for distributed jobs where each process reads a disjoint part of
+          the files. read_image_random and read_batch_random then only draw from this rank's part for the
+          current epoch (see 'set_epoch'), and DataLoader iterates over it. See 'Shard'.
+    
+    echo: default = None
+          Optionally, enables data echoing for read_image_random and read_batch_random, for when reading and
+          decoding is the bottleneck: each decoded image is kept in a pool and returned several times, each
+          time transformed afresh. Either a DataEcho instance or an integer giving the number of times each
+          image is returned. See 'DataEcho', whose 'stats' report the unique sample ratio and throughput.
     """
     def __init__(self, root, file_ids=None, suffix=None,
-                 transforms=None, randomize_transforms=False):
+                 transforms=None, randomize_transforms=False, cache=None, reduced_decode=True, index=None,
+                 profiler=None, byte_cache=None, output=None, shard=None, echo=None):
         self.PATH = root
+        self.profiler = profiler
+        self.byte_cache = ImageCache(byte_cache) if isinstance(byte_cache, (int, np.integer)) else byte_cache
+        if index is True:
+            index = ImageIndex(root)
+        elif isinstance(index, str):
+            index = ImageIndex(root, manifest=index)
+        elif index is False:
+            index = None
+        self.index = index
+        self._suffixes = None
+        self._rows = None
+        self.cache = ImageCache(cache) if isinstance(cache, (int, np.integer)) else cache
+        self.packed = PackedDataset(root) if is_packed(root) else None
+        self.pyramid = TiledPyramid(root) if is_pyramid(root) else None
         self.file_ids = file_ids
         self.suffix = suffix
         self.get_image_ids()
         self.len = len(self.file_ids)
         self.transforms = transforms
         assert randomize_transforms == True or randomize_transforms == False or len(randomize_transforms) == len(transforms)
+        self.transform_image = None
         if transforms:
-            self.transform_image = Transformer(transforms, randomize_transforms)
+            self.transform_image = Transformer(transforms, randomize_transforms, profiler=profiler)
+        self._pyramid_split = self.get_pyramid_split()
+        self._batch_buffer = None
+        self.reduced_decode = reduced_decode
+        self.reduction_limits = self.get_reduction_limits() if reduced_decode else None
+        self._reductions = {}
+        self._reduced_transformers = {}
+        self.output = output
+        self.keep_bgr = output is not None and self.packed is None and self.pyramid is None and \
+            all(getattr(tfm, 'channel_invariant', False) for tfm in transforms or [])
+        self.shard = shard
+        self.epoch = 0
+        self._shard_indices = {}
+        self._file_sizes = None
+        self._locality = shard.get_locality(self.file_ids) if shard is not None else None
+        self.echo = DataEcho(echo) if isinstance(echo, (int, np.integer)) else echo
+        if self.echo is not None and self.pyramid is not None:
+            raise ValueError("Echoing keeps decoded images, it can't be used with a pyramid")
         
     def get_image_ids(self):
         """ Function to infer image IDs"""
+        if self.packed is not None or self.pyramid is not None:
+            #IDs in a packed directory have no extension
+            ids = self.packed.ids if self.packed is not None else self.pyramid.ids
+            self.file_ids = ids if self.file_ids is None else np.asarray(self.file_ids)
+            self.suffix = ''
+            return
+        if self.index is not None:
+            self.get_image_ids_from_index()
+            return
         if self.file_ids:
             pass #file_ids provided by user
         else:
@@ -53,6 +160,37 @@ class ImageReader(object):
             self.suffix = self.file_ids[0][self.file_ids[0].find('.'):]
         self.file_ids = np.array(list(map(lambda x: x[0 : x.find('.')], self.file_ids)))
 
+    def get_image_ids_from_index(self):
+        """ Function to get image IDs and extensions from the ImageIndex"""
+        if self.file_ids is None:
+            self.file_ids = self.index.ids
+        else:
+            self.file_ids = np.asarray(self.file_ids)
+        if self.suffix:
+            return #suffix provided by user
+        suffixes = np.unique(self.index.suffixes)
+        if len(suffixes) == 1:
+            self.suffix = suffixes[0]
+        else:
+            self.suffix = None
+            self._suffixes = dict(zip(self.index.ids, self.index.suffixes))
+    
+    def get_image_path(self, ID):
+        """ Function to get the path of the image specified by ID"""
+        suffix = self.suffix if self._suffixes is None else self._suffixes[ID]
+        return os.path.join(self.PATH, ID + suffix)
+    
+    def get_indexed_size(self, ID):
+        """ Function to get the (height, width) of an image from the ImageIndex, or None if unknown"""
+        if self.index is None:
+            return None
+        if self._rows is None:
+            self._rows = {ID: i for i, ID in enumerate(self.index.ids)}
+        row = self._rows.get(ID)
+        if row is None or self.index.heights[row] == 0:
+            return None
+        return int(self.index.heights[row]), int(self.index.widths[row])
+    
     def read_image_from_id(self, ID):
         """
         Function to read an image specified by ID.
@@ -66,14 +204,264 @@ class ImageReader(object):
         -------
         An image of type numpy.ndarray with appropriate transformations
         """
+        return self.process_image(ID)
+    
+    def process_image(self, ID, data=None, params=None, out=None, formatted=True):
+        """
+        Function to decode the image specified by ID, transform it and format it (see 'output').
+        
+        Parameters
+        ----------
+        ID: The file ID.
+        
+        data: default = None
+            Optionally, the compressed file contents already fetched with 'fetch_bytes'.
+        
+        params: default = None
+            Optionally, one sample of an augmentation plan (see 'Transformer.make_plan').
+            If left to default, transformations are sampled from the global numpy random state.
+        
+        out: default = None
+            Optionally, an array to write the image into: the formatted image if 'output' is set, else the
+            transformed image. The transformations then write into it directly (see 'Transformer').
         
-        #Read image and shift channels to convert to RGB
-        img_path = os.path.join(self.PATH, ID + self.suffix)
+        formatted: default = True
+            If set to 'False', the output stage is skipped and the transformed RGB image is returned.
         
-        if self.transform_image:
-            return self.transform_image(cv2.imread(img_path)[:, :, ::-1])
+        Returns
+        -------
+        An image of type numpy.ndarray with appropriate transformations
+        """
+        if self.pyramid is not None:
+            img, transform_image, params = self.read_pyramid_image(ID, params)
+        else:
+            reduction = self.get_reduction(ID)
+            img = self.decode_image(ID, reduction, data, bgr=self.keep_bgr and formatted)
+            transform_image = self.get_transformer(reduction)
+        return self.transform_image_with(ID, img, transform_image, params, out, formatted)
+    
+    def transform_image_with(self, ID, img, transform_image, params=None, out=None, formatted=True):
+        """ Function to transform a decoded image with a Transformer (or None) and format it, see 'process_image'"""
+        output = self.output if formatted else None
+        # without an output stage, the last transformation writes into 'out', else the transformed image
+        # only has to live until it is formatted and can stay in the Transformer's scratch buffers
+        direct, temporary = (out, False) if output is None else (None, True)
+        if transform_image:
+            if params is None:
+                img = transform_image(img, direct, temporary)
+            else:
+                img = transform_image.apply_plan(img, params, direct, temporary)
+        elif direct is not None:
+            if img.shape != direct.shape:
+                raise ValueError("Image %s has shape %s but 'out' has shape %s" % (ID, img.shape, direct.shape))
+            np.copyto(direct, img, casting='unsafe')
+            img = direct
+        if output is None:
+            return img
+        if self.profiler is None:
+            return output(img, out, self.keep_bgr)
+        return self.profiler.timed('OutputFormat', output, img, out, self.keep_bgr)
+    
+    def decode_image(self, ID, reduction=1, data=None, bgr=False):
+        """
+        Function to read and decode an image specified by ID, without any transformations.
+        The image is decoded at 1/reduction of its size (reduction can be 1, 2, 4 or 8).
+        If a cache is set, the decoded image is looked up in / added to the cache.
+        Optionally, 'data' holds the compressed file contents already fetched with 'fetch_bytes'.
+        If 'bgr' is set, the channels are left in the BGR order of OpenCV (packed images are always RGB).
+        Cached and packed images are read-only.
+        """
+        if self.packed is not None:
+            return self.packed.get(ID)
+        if self.pyramid is not None:
+            return self.pyramid.get(ID)
+        flags = cv2.IMREAD_COLOR if reduction == 1 else getattr(cv2, 'IMREAD_REDUCED_COLOR_%d' % reduction)
+        if self.cache is not None:
+            key = ID if reduction == 1 else '%s@%d' % (ID, reduction)
+            img = self.cache.get(key)
+            if img is None:
+                img = self.cache.put(key, self.imread(ID, flags, data))
         else:
-            return cv2.imread(img_path)[:, :, ::-1]
+            img = self.imread(ID, flags, data)
+        #shift channels to convert to RGB
+        return img if bgr else img[:, :, ::-1]
+    
+    def imread(self, ID, flags=cv2.IMREAD_COLOR, data=None):
+        """
+        Function to read and decode the image file specified by ID (in BGR order).
+        With a profiler or a byte cache, or if 'data' is given, the file is read and decoded in two
+        separate steps, see 'fetch_bytes' and 'decode_bytes'.
+        """
+        if data is None:
+            if self.profiler is None and self.byte_cache is None:
+                return cv2.imread(self.get_image_path(ID), flags)
+            data = self.fetch_bytes(ID)
+        return self.decode_bytes(data, flags)
+    
+    def fetch_bytes(self, ID):
+        """
+        Function to read the compressed contents of the image file specified by ID, as a uint8 array.
+        If a byte cache is set, the contents are looked up in / added to it.
+        """
+        if self.byte_cache is not None:
+            data = self.byte_cache.get(ID)
+            if data is not None:
+                return data.reshape(-1)
+        start = time.perf_counter()
+        data = np.fromfile(self.get_image_path(ID), dtype=np.uint8)
+        if self.profiler is not None:
+            self.profiler.record('read', time.perf_counter() - start, data.nbytes)
+        if self.byte_cache is not None:
+            data = self.byte_cache.put(ID, data).reshape(-1)
+        return data
+    
+    def decode_bytes(self, data, flags=cv2.IMREAD_COLOR):
+        """ Function to decode compressed image contents with cv2.imdecode (in BGR order)"""
+        if self.profiler is None:
+            return cv2.imdecode(data, flags)
+        start = time.perf_counter()
+        img = cv2.imdecode(data, flags)
+        self.profiler.record('decode', time.perf_counter() - start)
+        return img
+    
+    def get_file_sizes(self):
+        """
+        Function to get the byte size of each file in file_ids, from the ImageIndex if there is one.
+        The sizes are only read once.
+        """
+        if self._file_sizes is None:
+            self._file_sizes = self.read_file_sizes()
+        return self._file_sizes
+    
+    def read_file_sizes(self):
+        """ See get_file_sizes"""
+        if self.packed is not None:
+            return self.packed.shapes[[self.packed.positions[ID] for ID in self.file_ids]].prod(axis=1)
+        if self.pyramid is not None:
+            return np.array([np.prod(self.pyramid.get_shape(ID)) for ID in self.file_ids], dtype=np.int64)
+        if self.index is not None:
+            if self._rows is None:
+                self._rows = {ID: i for i, ID in enumerate(self.index.ids)}
+            return self.index.sizes[[self._rows[ID] for ID in self.file_ids]]
+        return np.array([os.path.getsize(self.get_image_path(ID)) for ID in self.file_ids], dtype=np.int64)
+    
+    def set_epoch(self, epoch):
+        """ Function to set the epoch, which selects the permutation used with a shard"""
+        self.epoch = epoch
+    
+    def get_shard_indices(self, epoch=None):
+        """
+        Function to get the indices of the files of this rank for an epoch (the current one by default),
+        in shuffled order. Without a shard, all indices are returned in order.
+        """
+        if self.shard is None:
+            return np.arange(self.len)
+        epoch = self.epoch if epoch is None else epoch
+        indices = self._shard_indices.get(epoch)
+        if indices is None:
+            sizes = self.get_file_sizes() if self.shard.balance == 'bytes' else None
+            indices = self.shard.get_indices(epoch, self.len, sizes, self._locality)
+            # only the current and the next epoch are kept around
+            self._shard_indices = {e: v for e, v in self._shard_indices.items() if e >= epoch - 1}
+            self._shard_indices[epoch] = indices
+        return indices
+    
+    def get_reduction_limits(self):
+        """
+        Function to check if images can be decoded at reduced resolution (see 'reduced_decode').
+        Returns None if they can't, or a tuple (target, crop) where target = max(height, width) of the
+        final Crop_and_resize, and crop is either the fraction of the image left by its smallest random
+        crop (a float) or the (height, width) of its fixed crop box.
+        """
+        if not self.transforms or self.packed is not None or self.pyramid is not None:
+            return None
+        last = max([i for i, tfm in enumerate(self.transforms)
+                    if isinstance(tfm, Crop_and_resize) and tfm.resize_dims != -1], default=None)
+        if last is None or not self.transform_image.do_ops[last]:
+            return None
+        if not all(getattr(tfm, 'scale_invariant', False) for tfm in self.transforms[:last]):
+            return None
+        final = self.transforms[last]
+        target = max(final.resize_dims)
+        if final.do_crop == False:
+            return target, 1.0
+        elif final.box != -1:
+            return target, (final.box[1] - final.box[0], final.box[3] - final.box[2])
+        return target, 1.0 - final.amount
+    
+    def get_reduction(self, ID):
+        """ Function to get the factor by which the image specified by ID can be reduced when decoding"""
+        if self.reduction_limits is None:
+            return 1
+        reduction = self._reductions.get(ID)
+        if reduction is None:
+            reduction = 1
+            target, crop = self.reduction_limits
+            path = self.get_image_path(ID)
+            if os.path.splitext(path)[1].lower() not in JPEG_SUFFIXES:
+                available = 0
+            elif isinstance(crop, tuple):
+                available = min(crop)
+            else:
+                size = self.get_indexed_size(ID) or read_image_size(path)
+                # the header ignores EXIF orientation, so only rely on the shorter side
+                available = min(size) * crop if size else 0
+            for factor in (8, 4, 2):
+                if available / factor >= target:
+                    reduction = factor
+                    break
+            self._reductions[ID] = reduction
+        return reduction
+    
+    def get_transformer(self, reduction):
+        """ Function to get the Transformer for images decoded at 1/reduction of their size"""
+        if reduction == 1 or not self.transform_image:
+            return self.transform_image
+        if reduction not in self._reduced_transformers:
+            transforms = [tfm.scaled(1 / reduction) if hasattr(tfm, 'scaled') else tfm for tfm in self.transforms]
+            self._reduced_transformers[reduction] = Transformer(transforms, self.transform_image.randomize,
+                                                                self.transform_image.fuse, self.profiler)
+        return self._reduced_transformers[reduction]
+    
+    def get_pyramid_split(self):
+        """
+        Function to get the number of leading transformations resolved by reading from a pyramid
+        (see 'root'), with a Transformer for the remaining ones (or None).
+        """
+        if self.pyramid is None or not self.transforms:
+            return 0, self.transform_image
+        split = 0
+        while split < len(self.transforms) and hasattr(self.transforms[split], 'get_affine'):
+            split += 1
+        rest = list(range(split, len(self.transforms)))
+        return split, self.transform_image.subset(rest) if rest else None
+    
+    def read_pyramid_image(self, ID, params=None):
+        """
+        Function to read the image specified by ID from a pyramid, with the leading geometric transformations
+        applied. Their matrices are composed for the full resolution size first, so only the part of the
+        pyramid level the output maps to is read. Returns (image, Transformer for the remaining
+        transformations or None, plan sample for that Transformer or None).
+        """
+        split, rest = self._pyramid_split
+        shape = self.pyramid.get_shape(ID)[:2]
+        matrix, out_shape = np.eye(3), shape
+        if params is None and split:
+            operations = np.random.randint(0, 2, split) + self.transform_image.do_ops[:split]
+            for tfm, do_op in zip(self.transforms[:split], operations):
+                if do_op:
+                    op_matrix, out_shape = tfm.get_affine(out_shape)
+                    if op_matrix is not None:
+                        matrix = op_matrix @ matrix
+        elif params is not None:
+            matrix, out_shape = self.transform_image.plan_matrix(range(split), shape, params)
+            if rest is not None:
+                params = self.transform_image.permute_plan(np.asarray(params).reshape(1), range(split, self.transform_image.len))[0]
+        start = time.perf_counter()
+        img = self.pyramid.read_affine(ID, matrix, out_shape)
+        if self.profiler is not None:
+            self.profiler.record('read', time.perf_counter() - start, img.nbytes)
+        return img, rest, params
     
     def read_image_from_idx(self, idx):
         """
@@ -102,14 +490,135 @@ class ImageReader(object):
         -------
         An image of type numpy.ndarray with appropriate transformations
         """
+        if self.echo is not None:
+            return self.read_image_echoed()
+        if self.shard is not None:
+            return self.read_image_from_idx(np.random.choice(self.get_shard_indices()))
         idx = np.random.randint(0, self.len, 1)[0]
         return self.read_image_from_id(self.file_ids[idx])
     
+    def decode_random(self):
+        """
+        Function to decode a random image (from this rank's part with a shard), without transforming it.
+        Returns (ID, image, reduction), see 'decode_image'.
+        """
+        if self.shard is not None:
+            idx = np.random.choice(self.get_shard_indices())
+        else:
+            idx = np.random.randint(0, self.len)
+        ID = self.file_ids[idx]
+        reduction = self.get_reduction(ID)
+        return ID, self.decode_image(ID, reduction, bgr=self.keep_bgr), reduction
+    
+    def read_image_echoed(self, out=None):
+        """
+        Function to read the next image in echoing mode (see 'echo'): a decoded image is taken from the pool,
+        new ones being decoded as the pool empties, and transformed afresh. See 'process_image' for 'out'.
+        """
+        ID, img, reduction = self.echo.take(self.decode_random)
+        return self.transform_image_with(ID, img, self.get_transformer(reduction), out=out)
+    
+    def get_output_size(self):
+        """
+        Function to infer the fixed (height, width) of images returned by this reader.
+        The size is taken from the last 'Crop_and_resize' transform with 'sz' set.
+        Returns None if the output size depends on the input image.
+        """
+        if not self.transforms:
+            return None
+        for tfm in reversed(self.transforms):
+            if isinstance(tfm, Crop_and_resize):
+                if tfm.resize_dims == -1:
+                    return None
+                return (tfm.resize_dims[1], tfm.resize_dims[0])
+        return None
+    
+    def get_batch_shape(self, n, channels=3):
+        """
+        Function to get the (shape, dtype) of a batch of n images returned by this reader, i.e.
+        (n, height, width, channels) and uint8, or as given by 'output' if set.
+        """
+        size = self.get_output_size()
+        if size is None:
+            raise ValueError("Batched reads need a fixed output size. Add a Crop_and_resize(sz=(width, height)) "
+                             "as the last transform or pass a preallocated 'out' buffer.")
+        if self.output is None:
+            return (n, size[0], size[1], channels), np.dtype(np.uint8)
+        return (n,) + self.output.get_shape((size[0], size[1], channels)), self.output.dtype
+    
+    def get_batch_buffer(self, n, channels=3):
+        """
+        Function to get a contiguous buffer for a batch of n images (see 'get_batch_shape').
+        The buffer is allocated once and reused by subsequent calls asking for the same
+        or a smaller batch, so the contents are overwritten on every call.
+        """
+        shape, dtype = self.get_batch_shape(n, channels)
+        buf = self._batch_buffer
+        if buf is None or buf.shape[0] < n or buf.shape[1:] != shape[1:] or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._batch_buffer = buf
+        return buf[:n]
+    
+    def read_image_planned(self, idx, params):
+        """
+        Function to read the image at index idx, transformed with one sample of an augmentation plan.
+        See 'Transformer.make_plan'.
+        """
+        return self.process_image(self.file_ids[idx], params=params)
+    
+    def read_batch(self, indices, out=None, plan=None):
+        """
+        Function to read a batch of images specified by indices into a single array.
+        
+        Parameters
+        ----------
+        indices: An iterable of file indices.
+        
+        out: default = None
+            Optionally, a C-contiguous uint8 array of shape (len(indices), height, width, channels)
+            to write the images into (or of the shape and dtype given by 'output', see 'get_batch_shape').
+            If left to default, an internal buffer is reused across calls, so the returned array
+            is only valid until the next call to read_batch.
+        
+        plan: default = None
+            Optionally, an augmentation plan (see 'Transformer.make_plan') with one sample per index.
+            If left to default, transformations are sampled from the global numpy random state.
+            
+        Returns
+        -------
+        An array of type numpy.ndarray and shape (N, H, W, C) with appropriate transformations
+        """
+        indices = np.asarray(indices).reshape(-1)
+        if out is None:
+            out = self.get_batch_buffer(len(indices))
+        elif out.shape[0] != len(indices) or out.ndim != 4:
+            raise ValueError("'out' should have shape (%d, height, width, channels), got %s"
+                             % (len(indices), out.shape))
+        for i, idx in enumerate(indices):
+            #transformed or formatted directly into the batch
+            self.process_image(self.file_ids[idx], params=None if plan is None else plan[i], out=out[i])
+        return out
+    
+    def read_batch_random(self, batch_size, out=None):
+        """
+        Function to read a batch of random images from root folder.
+        See 'read_batch' for details on 'out'. In echoing mode (see 'echo'), images come from the pool.
+        """
+        if self.echo is not None:
+            if out is None:
+                out = self.get_batch_buffer(batch_size)
+            for i in range(batch_size):
+                self.read_image_echoed(out[i])
+            return out
+        if self.shard is not None:
+            return self.read_batch(np.random.choice(self.get_shard_indices(), batch_size), out=out)
+        return self.read_batch(np.random.randint(0, self.len, batch_size), out=out)
+    
     def show_by_id(self, ID):
         """
-        Plot image specified by ID
+        Plot image specified by ID, transformed but without the output stage (see 'output')
         """
-        plt.imshow(self.read_image_from_id(ID))
+        plt.imshow(self.process_image(ID, formatted=False))
     
     def show_random(self):
         """
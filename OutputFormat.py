@@ -0,0 +1,134 @@
+import threading
+import cv2
+import numpy as np
+
+class OutputFormat(object):
+    """
+    This class provides callable instances that turn a transformed uint8 image into exactly the array
+    a model consumes, in one pass: channel order (RGB), data type, per-channel normalization and layout.
+    Each output value is (value * scale - mean) / std. Since the input is uint8, this is precomputed into
+    a 256 entry lookup table per channel, which is applied with cv2.LUT directly into the output array,
+    so no full size float intermediates are allocated.
+
+    Parameters
+    ----------
+    dtype: default = np.float32
+          Data type of the output, one of np.uint8, np.float16 and np.float32.
+          uint8 outputs are rounded and clipped to [0, 255].
+
+    mean: default = 0
+          A scalar or one value per channel (in RGB order) subtracted after scaling
+
+    std: default = 1
+          A scalar or one value per channel (in RGB order) the result is divided by
+
+    scale: default = None
+          Factor applied to the uint8 values first. If left to default, 1/255 for float outputs and
+          1 for uint8 outputs.
+
+    layout: default = 'HWC'
+          'HWC' for (height, width, channels) outputs, 'CHW' for (channels, height, width) outputs.
+
+    Returns
+    -------
+    A callable instance of the class that acts as a function.
+    The function takes as argument an image of type numpy.ndarray of shape (H, W, C), an optional
+    preallocated output array 'out' and 'bgr', set to 'True' if the channels of the image are in BGR order.
+    Returns: the formatted image
+
+    Example Usage :
+    fmt = OutputFormat(np.float32, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), layout='CHW')
+    imr = ImageReader(PATH_TO_IMAGES, transforms=tfms, output=fmt)
+    """
+    def __init__(self, dtype=np.float32, mean=0, std=1, scale=None, layout='HWC'):
+        assert layout in ('HWC', 'CHW')
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in (np.uint8, np.float16, np.float32)
+        self.mean = mean
+        self.std = std
+        self.scale = scale if scale is not None else (1 if self.dtype == np.uint8 else 1 / 255)
+        self.layout = layout
+        self._tables = {}
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def get_buffer(self, shape):
+        """
+        Returns a uint8 array of the given shape in a buffer of the calling thread, which grows to the
+        largest size asked for and is then reused
+        """
+        size = int(np.prod(shape))
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or buf.size < size:
+            buf = self._local.buffer = np.empty(size, dtype=np.uint8)
+        return buf[:size].reshape(shape)
+
+    def get_shape(self, shape):
+        """ Function to get the output shape for an image of shape (H, W, C)"""
+        h, w, c = shape
+        return (c, h, w) if self.layout == 'CHW' else (h, w, c)
+
+    def get_table(self, channels):
+        """ Function to get the lookup table of shape (1, 256, channels) mapping uint8 values to output values"""
+        table = self._tables.get(channels)
+        if table is None:
+            mean = np.broadcast_to(np.asarray(self.mean, dtype=np.float64), (channels,))
+            std = np.broadcast_to(np.asarray(self.std, dtype=np.float64), (channels,))
+            table = (np.arange(256, dtype=np.float64)[:, None] * self.scale - mean) / std
+            if self.dtype == np.uint8:
+                table = np.clip(np.rint(table), 0, 255)
+            table = np.ascontiguousarray(table[None].astype(self.dtype))
+            # single channel tables, for planar outputs
+            planes = [np.ascontiguousarray(table[:, :, c]) for c in range(channels)]
+            self._tables[channels] = table = (table, planes)
+        return table
+
+    def __call__(self, img, out=None, bgr=False):
+        shape = self.get_shape(img.shape)
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        elif out.shape != shape or out.dtype != self.dtype or not out.flags.c_contiguous:
+            raise ValueError("'out' should be a C-contiguous %s array of shape %s, got a %s array of shape %s"
+                             % (self.dtype, shape, out.dtype, out.shape))
+        if img.dtype != np.uint8:
+            return self.apply_float(img, out, bgr)
+        channels = img.shape[2]
+        table, planes = self.get_table(channels)
+        if self.layout == 'HWC':
+            if bgr:
+                # reorder the uint8 image first, a quarter of the size of a float32 output, into a reused buffer
+                rgb = self.get_buffer(img.shape)
+                cv2.mixChannels([img], [rgb], [k for c in range(channels) for k in (channels - 1 - c, c)])
+                img = rgb
+            cv2.LUT(img, table, dst=out)
+            return out
+        # each channel is extracted into a reused uint8 plane and mapped directly into its place in the output
+        plane = self.get_buffer(img.shape[:2])
+        for c in range(channels):
+            cv2.extractChannel(img, channels - 1 - c if bgr else c, dst=plane)
+            cv2.LUT(plane, planes[c], dst=out[c])
+        return out
+
+    def apply_float(self, img, out, bgr=False):
+        """ Function to format an image that isn't uint8, with numpy arithmetic"""
+        src = img[:, :, ::-1] if bgr else img
+        if self.layout == 'CHW':
+            src = src.transpose(2, 0, 1)
+            mean = np.asarray(self.mean, dtype=np.float32).reshape(-1, 1, 1)
+            std = np.asarray(self.std, dtype=np.float32).reshape(-1, 1, 1)
+        else:
+            mean = np.asarray(self.mean, dtype=np.float32)
+            std = np.asarray(self.std, dtype=np.float32)
+        value = (src * np.float32(self.scale) - mean) / std
+        if self.dtype == np.uint8:
+            value = np.clip(np.rint(value), 0, 255)
+        np.copyto(out, value, casting='unsafe')
+        return out
@@ -0,0 +1,104 @@
+import os
+import cv2
+import numpy as np
+
+PIXELS_FILE = 'pixels.bin'
+INDEX_FILE = 'index.npz'
+
+def is_packed(path):
+    """ Returns True if 'path' is a directory written by pack_images"""
+    return (os.path.isfile(os.path.join(path, PIXELS_FILE)) and
+            os.path.isfile(os.path.join(path, INDEX_FILE)))
+
+def pack_images(reader, out_dir, sz=None):
+    """
+    Function to decode every image of an ImageReader once and write them to a packed directory,
+    which can then be passed as 'root' to ImageReader. No transformations are applied.
+
+    Parameters
+    ----------
+    reader: An instance of ImageReader. All images in reader.file_ids are packed.
+
+    out_dir: Path to the directory to write. It is created if it does not exist.
+          The directory contains 'pixels.bin', the raw RGB uint8 pixels of every image one after
+          the other, and 'index.npz', which holds the ID, byte offset and shape of each image.
+
+    sz: default = None
+          Optionally, an iterable of form (width, height) to resize each image to before packing.
+
+    Returns
+    -------
+    An instance of PackedDataset opened on out_dir
+
+    Example Usage:
+    pack_images(ImageReader(PATH_TO_IMAGES), PATH_TO_PACKED, sz=(256, 256))
+    imr = ImageReader(PATH_TO_PACKED, transforms=tfms)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    offsets = np.zeros(reader.len, dtype=np.int64)
+    shapes = np.zeros((reader.len, 3), dtype=np.int32)
+    offset = 0
+    with open(os.path.join(out_dir, PIXELS_FILE), 'wb') as f:
+        for i, ID in enumerate(reader.file_ids):
+            img = reader.decode_image(ID)
+            if sz is not None:
+                interp = cv2.INTER_AREA if sz[0] * sz[1] < img.shape[0] * img.shape[1] else cv2.INTER_LINEAR
+                img = cv2.resize(img, (sz[0], sz[1]), interpolation=interp)
+            img = np.ascontiguousarray(img, dtype=np.uint8)
+            f.write(img.data)
+            offsets[i] = offset
+            shapes[i] = img.shape
+            offset += img.nbytes
+    np.savez(os.path.join(out_dir, INDEX_FILE), ids=np.asarray(reader.file_ids), offsets=offsets, shapes=shapes)
+    return PackedDataset(out_dir)
+
+class PackedDataset(object):
+    """
+    This class provides read access to a directory written by pack_images.
+    The pixels are memory mapped, so reading an image returns a read-only view onto the
+    mapping without copying or decoding, and processes opening the same directory share
+    one copy of the data in the OS page cache.
+
+    Parameters
+    ----------
+    path: Path to a directory written by pack_images
+
+    Example Usage:
+    packed = PackedDataset(PATH_TO_PACKED)
+    image = packed[0]
+    image = packed.get(packed.ids[0])
+    """
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        index = np.load(os.path.join(self.path, INDEX_FILE))
+        self.ids = index['ids']
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.positions = {ID: i for i, ID in enumerate(self.ids)}
+        if self.shapes.prod(axis=1).sum() > 0:
+            self.data = np.memmap(os.path.join(self.path, PIXELS_FILE), dtype=np.uint8, mode='r').view(np.ndarray)
+        else:
+            self.data = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        # reopen the mapping instead of pickling the pixels
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        start = self.offsets[idx]
+        shape = tuple(self.shapes[idx])
+        return self.data[start:start + shape[0] * shape[1] * shape[2]].reshape(shape)
+
+    def get(self, ID):
+        """ Returns the image with the given ID"""
+        return self[self.positions[ID]]
@@ -0,0 +1,160 @@
+import asyncio
+import collections
+import queue
+import threading
+import concurrent.futures as cf
+import numpy as np
+
+_DONE = object()
+
+class PipelinedReader(object):
+    """
+    This class provides instances that read images from an ImageReader in two overlapping stages,
+    for storage where reading a file has a long latency (e.g. network file systems):
+    - fetch: an asyncio event loop keeps up to 'max_inflight' file reads in flight, each reading the
+      compressed file contents into memory (see 'ImageReader.fetch_bytes')
+    - decode: a pool of 'num_decoders' threads decodes the contents with cv2.imdecode and applies the
+      transformations. OpenCV releases the GIL while decoding, so threads run in parallel.
+    The two stages are connected by a bounded queue of 'queue_size' images, so fetching never runs
+    more than max_inflight + queue_size images ahead of the consumer.
+    Combined with the reader's 'byte_cache', later epochs are read from memory but still decoded and
+    transformed afresh. Images of a packed directory or a pyramid have nothing to fetch and are read by the decoders.
+
+    Parameters
+    ----------
+    reader: An instance of ImageReader
+
+    max_inflight: default = 64
+          Maximum number of files being read at the same time
+
+    num_decoders: default = 4
+          Number of threads decoding and transforming images
+
+    queue_size: default = None
+          Maximum number of fetched images waiting for or being decoded.
+          If left to default, 2 * num_decoders is used.
+
+    Example Usage:
+    imr = ImageReader(PATH_TO_IMAGES, transforms=tfms, byte_cache=4 * 1024**3)
+    pipe = PipelinedReader(imr, max_inflight=128)
+    for idx, img in pipe.imap(range(imr.len)):
+        ...
+    batch = pipe.read_batch(range(64))
+    """
+    def __init__(self, reader, max_inflight=64, num_decoders=4, queue_size=None):
+        assert max_inflight > 0 and num_decoders > 0
+        self.reader = reader
+        self.max_inflight = max_inflight
+        self.num_decoders = num_decoders
+        self.queue_size = queue_size if queue_size else 2 * num_decoders
+        self._fetchers = cf.ThreadPoolExecutor(max_inflight)
+        self._decoders = cf.ThreadPoolExecutor(num_decoders)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._fetchers.shutdown(wait=True)
+        self._decoders.shutdown(wait=True)
+
+    def fetch(self, idx):
+        """ Function to read the compressed contents of the image at index idx (None for packed images)"""
+        if self.reader.packed is not None or self.reader.pyramid is not None:
+            return None
+        return self.reader.fetch_bytes(self.reader.file_ids[idx])
+
+    def decode(self, idx, data, params=None):
+        """ Function to decode and transform the image at index idx from its fetched contents"""
+        return self.reader.process_image(self.reader.file_ids[idx], data, params)
+
+    async def produce(self, indices, plan, ready, stop):
+        """
+        Coroutine fetching the images at 'indices' and submitting them, in order, to the decoders.
+        The decode futures are put on the bounded queue 'ready', followed by _DONE.
+        """
+        loop = asyncio.get_running_loop()
+        fetches = collections.deque()
+        try:
+            for i, idx in enumerate(indices):
+                fetches.append((i, loop.run_in_executor(self._fetchers, self.fetch, idx)))
+                await asyncio.sleep(0)
+                # reads complete in any order, but are handed to the decoders in order
+                while fetches and (fetches[0][1].done() or len(fetches) >= self.max_inflight):
+                    await self.submit(*fetches.popleft(), indices, plan, ready)
+                if stop.is_set():
+                    return
+            while fetches and not stop.is_set():
+                await self.submit(*fetches.popleft(), indices, plan, ready)
+        except Exception as e:
+            future = cf.Future()
+            future.set_exception(e)
+            await loop.run_in_executor(None, ready.put, future)
+        finally:
+            for _, fetch in fetches:
+                fetch.cancel()
+            await loop.run_in_executor(None, ready.put, _DONE)
+
+    async def submit(self, i, fetch, indices, plan, ready):
+        data = await fetch
+        params = None if plan is None else plan[i]
+        future = self._decoders.submit(self.decode, indices[i], data, params)
+        # blocks while the queue is full, which holds back fetching
+        await asyncio.get_running_loop().run_in_executor(None, ready.put, future)
+
+    def imap(self, indices, plan=None):
+        """
+        Function to read the images at 'indices', in order.
+
+        Parameters
+        ----------
+        indices: An iterable of file indices.
+
+        plan: default = None
+            Optionally, an augmentation plan (see 'Transformer.make_plan') with one sample per index.
+
+        Returns
+        -------
+        A generator of (index, image) pairs
+        """
+        indices = np.asarray(indices).reshape(-1)
+        ready = queue.Queue(self.queue_size)
+        stop = threading.Event()
+        producer = threading.Thread(target=asyncio.run, args=(self.produce(indices, plan, ready, stop),),
+                                    daemon=True)
+        producer.start()
+        try:
+            for idx in indices:
+                future = ready.get()
+                if future is _DONE:
+                    break
+                yield idx, future.result()
+        finally:
+            stop.set()
+            # unblock the producer if it is waiting on a full queue
+            while producer.is_alive():
+                try:
+                    ready.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            producer.join()
+
+    def read_batch(self, indices, out=None, plan=None):
+        """
+        Function to read a batch of images specified by indices into a single array.
+        See 'ImageReader.read_batch' for details on 'out' and 'plan'.
+        """
+        indices = np.asarray(indices).reshape(-1)
+        if out is None:
+            out = self.reader.get_batch_buffer(len(indices))
+        elif out.shape[0] != len(indices) or out.ndim != 4:
+            raise ValueError("'out' should have shape (%d, height, width, channels), got %s"
+                             % (len(indices), out.shape))
+        for i, (idx, img) in enumerate(self.imap(indices, plan)):
+            if img.shape != out.shape[1:]:
+                raise ValueError("Image %s has shape %s but the batch expects %s"
+                                 % (self.reader.file_ids[idx], img.shape, out.shape[1:]))
+            np.copyto(out[i], img, casting='unsafe')
+        return out
@@ -0,0 +1,118 @@
+import threading
+import time
+
+# histogram bucket k counts durations in [2^(k-1), 2^k) microseconds, bucket 0 counts durations below 1us
+NUM_BUCKETS = 32
+
+class _Stage(object):
+    __slots__ = ('count', 'total', 'min', 'max', 'nbytes', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.nbytes = 0
+        self.buckets = [0] * NUM_BUCKETS
+
+class Profiler(object):
+    """
+    This class provides instances that collect timings of the stages of reading and transforming images.
+    Pass an instance as 'profiler' to an ImageReader (or a Transformer) to record:
+    - the wall time of each stage: 'read' (reading the file), 'decode' and each transformation by
+      class name (fused transformations are recorded together, e.g. 'Horizontal_flip+Crop_and_resize'),
+      aggregated into a count, total, min, max and a histogram with power of two buckets in microseconds
+    - the number of bytes read from disk
+    - how often each transformation was called and how often it actually modified the image
+    When no profiler is set, the only cost is one 'is None' check per image and per transformation.
+
+    Parameters
+    ----------
+    hooks: default = None
+          Optionally, a list of callables, called as hook(stage, seconds, nbytes) for every recorded
+          stage, e.g. to push the numbers into an external metrics system.
+
+    Each process has its own copy of a profiler: with DataLoader(backend='process'), the timings of
+    the workers are not visible in the parent process. Use hooks to send them elsewhere.
+
+    Example Usage:
+    profiler = Profiler()
+    imr = ImageReader(PATH_TO_IMAGES, transforms=tfms, profiler=profiler)
+    imr.read_batch(range(64))
+    profiler.snapshot()['stages']['decode']['mean_s']
+    """
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks) if hooks else []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """ Function to clear everything recorded so far"""
+        with self._lock:
+            self._stages = {}
+            self._fired = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, stage, seconds, nbytes=0):
+        """ Function to record that 'stage' took 'seconds' and processed 'nbytes' bytes"""
+        bucket = min(int(seconds * 1e6).bit_length(), NUM_BUCKETS - 1)
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = _Stage()
+            stats.count += 1
+            stats.total += seconds
+            stats.nbytes += nbytes
+            stats.buckets[bucket] += 1
+            if seconds < stats.min:
+                stats.min = seconds
+            if seconds > stats.max:
+                stats.max = seconds
+        for hook in self.hooks:
+            hook(stage, seconds, nbytes)
+
+    def count(self, name, fired):
+        """ Function to record that transformation 'name' was called, and if it modified the image"""
+        with self._lock:
+            counts = self._fired.get(name)
+            if counts is None:
+                counts = self._fired[name] = [0, 0]
+            counts[0] += 1
+            counts[1] += bool(fired)
+
+    def timed(self, stage, fn, *args):
+        """ Function to call fn(*args) and record its duration under 'stage'"""
+        start = time.perf_counter()
+        result = fn(*args)
+        self.record(stage, time.perf_counter() - start)
+        return result
+
+    def snapshot(self):
+        """
+        Function to get everything recorded so far as a dict of plain python types:
+        {'stages': {stage: {'count', 'total_s', 'mean_s', 'min_s', 'max_s', 'bytes', 'histogram_us'}},
+         'fired': {transformation: {'calls', 'fired', 'rate'}}}
+        'histogram_us' is a list of (upper bound in microseconds, count) for the non-empty buckets.
+        """
+        with self._lock:
+            stages = {name: {'count': s.count, 'total_s': s.total, 'mean_s': s.total / s.count,
+                             'min_s': s.min, 'max_s': s.max, 'bytes': s.nbytes,
+                             'histogram_us': [(2 ** k, n) for k, n in enumerate(s.buckets) if n]}
+                      for name, s in self._stages.items()}
+            fired = {name: {'calls': calls, 'fired': n, 'rate': n / calls}
+                     for name, (calls, n) in self._fired.items()}
+        return {'stages': stages, 'fired': fired}
@@ -0,0 +1,125 @@
+import numpy as np
+
+class Shard(object):
+    """
+    This class describes the part of a dataset read by one process of a distributed job.
+    Every epoch, the file indices are shuffled with a permutation seeded by (seed, epoch), which is
+    the same on every rank, and split into 'world_size' disjoint partitions. Each rank computes the
+    partitions on its own, so no communication is needed, and only keeps its own indices.
+
+    Parameters
+    ----------
+    rank: Index of this process, in [0, world_size)
+
+    world_size: Number of processes
+
+    seed: default = 0
+          Seed of the per-epoch permutations. It has to be the same on every rank.
+
+    shuffle: default = True
+          If set to 'False', files are partitioned in the order of file_ids every epoch
+
+    balance: default = 'count'
+          'count' to give every rank the same number of files (within one), 'bytes' to give every rank
+          about the same number of bytes to read (within the size of one file). With 'bytes', file sizes
+          are taken from the ImageIndex of the reader if it has one, and read from disk otherwise.
+
+    locality: default = None
+          Optionally, the preferred rank of every file, e.g. the rank whose node holds the file in a local
+          cache or shard, with -1 for files without a preference. Either an array with one entry per
+          file ID, or a callable taking a file ID and returning its preferred rank.
+          Each rank then first takes its preferred files, up to its balanced share, and files in
+          excess or without a preference are spread over the ranks with room left.
+
+    drop_last: default = False
+          If set to 'True' (with balance='count'), the last len(file_ids) % world_size files of each
+          epoch's permutation are dropped, so that every rank gets exactly the same number of files
+          (without 'locality', which can leave the counts one apart).
+
+    Example Usage:
+    shard = Shard(rank=int(os.environ['RANK']), world_size=int(os.environ['WORLD_SIZE']), seed=0)
+    imr = ImageReader(PATH_TO_IMAGES, transforms=tfms, shard=shard)
+    imr.set_epoch(epoch)
+    """
+    def __init__(self, rank, world_size, seed=0, shuffle=True, balance='count', locality=None, drop_last=False):
+        assert 0 <= rank < world_size
+        assert balance in ('count', 'bytes')
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.shuffle = shuffle
+        self.balance = balance
+        self.locality = locality
+        self.drop_last = drop_last
+
+    def get_locality(self, file_ids):
+        """ Function to get the preferred rank of every file as an array, or None"""
+        if self.locality is None:
+            return None
+        if callable(self.locality):
+            locality = np.array([self.locality(ID) for ID in file_ids], dtype=np.int64)
+        else:
+            locality = np.asarray(self.locality, dtype=np.int64)
+        if len(locality) != len(file_ids) or (locality >= self.world_size).any():
+            raise ValueError("'locality' should give a rank in [-1, %d) for each of the %d files"
+                             % (self.world_size, len(file_ids)))
+        return locality
+
+    def get_owners(self, order, weights, locality=None):
+        """
+        Function to assign each file of a permutation 'order' to a rank.
+        'weights' (in permutation order) is what gets balanced. Returns the rank of each entry of 'order'.
+        """
+        n, world_size = len(order), self.world_size
+        if locality is None:
+            if self.balance == 'count':
+                return np.arange(n) % world_size
+            # contiguous runs of the permutation holding 1 / world_size of the bytes each
+            middle = np.cumsum(weights) - weights / 2
+            return np.minimum((middle * world_size / max(weights.sum(), 1)).astype(np.int64), world_size - 1)
+        quota = weights.sum() / world_size
+        preferred = locality[order]
+        # preferred files of each rank, in permutation order, up to its share
+        rows = np.flatnonzero(preferred >= 0)
+        rows = rows[np.argsort(preferred[rows], kind='stable')]
+        groups = preferred[rows]
+        cumulative = np.cumsum(weights[rows])
+        starts = np.searchsorted(groups, groups, side='left')
+        cumulative = cumulative - np.concatenate([[0], cumulative])[starts]
+        owners = np.full(n, -1, dtype=np.int64)
+        kept = rows[cumulative <= quota + 1e-9]
+        owners[kept] = preferred[kept]
+        # the other files fill the room left, in permutation order
+        room = np.maximum(quota - np.bincount(owners[kept], weights[kept], minlength=world_size), 0)
+        pool = np.flatnonzero(owners < 0)
+        if len(pool):
+            middle = np.cumsum(weights[pool]) - weights[pool] / 2
+            middle = middle * room.sum() / weights[pool].sum()
+            owners[pool] = np.minimum(np.searchsorted(np.cumsum(room), middle, side='right'), world_size - 1)
+        return owners
+
+    def get_indices(self, epoch, num_files, sizes=None, locality=None):
+        """
+        Function to get the indices of the files read by this rank in epoch 'epoch', in shuffled order.
+
+        Parameters
+        ----------
+        epoch: The epoch number
+
+        num_files: Total number of files
+
+        sizes: default = None
+              Byte size of each file, needed with balance='bytes'
+
+        locality: default = None
+              Preferred rank of each file, see 'get_locality'
+        """
+        rng = np.random.default_rng(np.random.SeedSequence([self.seed, epoch]))
+        order = rng.permutation(num_files) if self.shuffle else np.arange(num_files)
+        if self.drop_last and self.balance == 'count':
+            order = order[:num_files - num_files % self.world_size]
+        if self.balance == 'bytes':
+            weights = np.asarray(sizes, dtype=np.float64)[order]
+        else:
+            weights = np.ones(len(order))
+        return order[self.get_owners(order, weights, locality) == self.rank]
@@ -0,0 +1,72 @@
+import weakref
+from multiprocessing import shared_memory
+import numpy as np
+from ImageCache import _open_shared_memory
+
+class SharedBatchRing(object):
+    """
+    This class provides a ring of fixed-shape batch slots held in shared memory, used to hand batches
+    from worker processes to the parent without pickling the pixels: a worker writes its batch directly
+    into a slot and only sends back the slot number. The parent then reads the batch in place.
+    The instance has to be created in the parent process; passing it to a worker process (e.g. in the
+    initargs of a pool) attaches the worker to the same memory.
+    The ring does not track which slots are in use, see DataLoader for how slots are recycled.
+
+    Parameters
+    ----------
+    num_slots: Number of batches held by the ring
+
+    batch_shape: Shape of one batch, e.g. (batch_size, height, width, channels)
+
+    dtype: default = np.uint8
+          Data type of the batches
+
+    Call 'unlink' from the creating process once the ring is no longer needed. This is also done
+    when the instance is garbage collected in the creating process.
+    """
+    def __init__(self, num_slots, batch_shape, dtype=np.uint8):
+        self.num_slots = int(num_slots)
+        self.batch_shape = tuple(batch_shape)
+        self.dtype = np.dtype(dtype)
+        self._owner = True
+        size = self.num_slots * int(np.prod(self.batch_shape)) * self.dtype.itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self._attach()
+        self._finalizer = weakref.finalize(self, _release, self._shm, True)
+
+    def _attach(self):
+        self._slots = np.ndarray((self.num_slots,) + self.batch_shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {'num_slots': self.num_slots, 'batch_shape': self.batch_shape, 'dtype': self.dtype.str,
+                'name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.num_slots = state['num_slots']
+        self.batch_shape = state['batch_shape']
+        self.dtype = np.dtype(state['dtype'])
+        self._owner = False
+        self._shm = _open_shared_memory(state['name'])
+        self._attach()
+        self._finalizer = weakref.finalize(self, _release, self._shm, False)
+
+    def __len__(self):
+        return self.num_slots
+
+    def slot(self, i):
+        """ Returns the array of shape batch_shape backed by slot i"""
+        return self._slots[i]
+
+    def unlink(self):
+        """ Releases the shared memory. Arrays returned by 'slot' must not be used afterwards."""
+        self._slots = None
+        self._finalizer()
+
+def _release(shm, unlink):
+    try:
+        shm.close()
+    except BufferError:
+        # batches handed out are still referenced, the memory is freed once they are gone
+        pass
+    if unlink:
+        shm.unlink()
@@ -0,0 +1,230 @@
+import io
+import os
+import tarfile
+import concurrent.futures as cf
+import cv2
+import numpy as np
+from Transformer import *
+from ImageIndex import IMAGE_SUFFIXES
+
+def pack_tar_shards(reader, out_dir, shard_bytes=256 * 1024**2, num_shards=None, shuffle=True, seed=0):
+    """
+    Function to copy the image files of an ImageReader into tar shards of about the same size, which can
+    then be read sequentially with TarStreamReader. Files are stored as they are, without decoding them.
+
+    Parameters
+    ----------
+    reader: An instance of ImageReader. All images in reader.file_ids are packed.
+
+    out_dir: Path to the directory to write the shards to ('shard-000000.tar', ...).
+          It is created if it does not exist.
+
+    shard_bytes: default = 256 MB
+          Target size of each shard. Ignored if num_shards is given.
+
+    num_shards: default = None
+          Optionally, the number of shards to write
+
+    shuffle: default = True
+          If set to 'True', files are shuffled (with 'seed') before being split into shards, so each
+          shard holds a random sample of the dataset. TarStreamReader only shuffles approximately,
+          so this matters when file_ids are sorted by class.
+
+    Returns
+    -------
+    The list of paths of the shards
+
+    Example Usage:
+    shards = pack_tar_shards(ImageReader(PATH_TO_IMAGES, index=True), PATH_TO_SHARDS)
+    stream = TarStreamReader(shards, transforms=tfms)
+    """
+    if reader.packed is not None or reader.pyramid is not None:
+        raise ValueError("Images of a packed directory are already decoded, pack the original directory instead")
+    os.makedirs(out_dir, exist_ok=True)
+    sizes = reader.get_file_sizes()
+    order = np.random.default_rng(seed).permutation(reader.len) if shuffle else np.arange(reader.len)
+    total = int(sizes.sum())
+    if num_shards is None:
+        num_shards = max(1, -(-total // shard_bytes))
+    num_shards = min(num_shards, max(reader.len, 1))
+    # contiguous runs of the order holding about total / num_shards bytes each
+    middle = np.cumsum(sizes[order]) - sizes[order] / 2
+    owners = np.minimum((middle * num_shards / max(total, 1)).astype(np.int64), num_shards - 1)
+    paths = []
+    for shard in range(num_shards):
+        path = os.path.join(out_dir, 'shard-%06d.tar' % shard)
+        with tarfile.open(path, 'w') as tar:
+            for idx in order[owners == shard]:
+                ID = reader.file_ids[idx]
+                path_in = reader.get_image_path(ID)
+                info = tarfile.TarInfo(ID + os.path.splitext(path_in)[1])
+                data = reader.fetch_bytes(ID)
+                info.size = data.nbytes
+                tar.addfile(info, io.BytesIO(data.tobytes()))
+        paths.append(path)
+    return paths
+
+class TarStreamReader(object):
+    """
+    This class provides iterable instances that stream images from tar shards (such as written by
+    'pack_tar_shards'), reading each shard sequentially from start to end. Images are decoded as they
+    stream past and transformed like in ImageReader. Files in the shards that aren't images are skipped.
+    Shuffling is approximate: the order of the shards is shuffled every epoch, and images go through a
+    buffer of 'shuffle_buffer' compressed files from which the next image is drawn at random.
+
+    Parameters
+    ----------
+    shards: A list of paths to tar files
+
+    transforms: default = None
+          A list of transformations to be applied to each image. See 'Transformer' for more details.
+
+    randomize_transforms: default = False
+          Parameter to randomize transformations. See 'Transformer' for more details
+
+    shuffle_buffer: default = 1000
+          Number of compressed files held to shuffle images. Set to 0 or 1 to read images in order.
+
+    shuffle_shards: default = True
+          If set to 'True', the order of the shards is shuffled every epoch
+
+    seed: default = None
+          If left to default, the global numpy random state is used for shuffling. Optionally, an integer
+          seed: the order of shards and images of epoch e then only depends on seed and e.
+
+    shard: default = None
+          Optionally, a Shard instance to split the tar shards between the ranks of a distributed job:
+          each rank reads its own subset of the shards every epoch. Needs at least world_size shards.
+
+    output: default = None
+          Optionally, an OutputFormat instance, see 'ImageReader'
+
+    num_workers: default = 0
+          Number of threads decoding and transforming the images of a batch in 'iter_batches'
+
+    Returns
+    -------
+    An iterable instance. Each iteration is one epoch and yields (ID, image) pairs.
+
+    Example Usage:
+    stream = TarStreamReader(glob.glob(PATH_TO_SHARDS + '/*.tar'), transforms=tfms, shuffle_buffer=2000)
+    for epoch in range(10):
+        for batch in stream.iter_batches(64):
+            train_step(batch)
+    """
+    def __init__(self, shards, transforms=None, randomize_transforms=False, shuffle_buffer=1000,
+                 shuffle_shards=True, seed=None, shard=None, output=None, num_workers=0):
+        self.shards = list(shards)
+        self.transforms = transforms
+        self.transform_image = Transformer(transforms, randomize_transforms) if transforms else None
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_shards = shuffle_shards
+        self.seed = seed
+        self.shard = shard
+        self.output = output
+        self.keep_bgr = output is not None and \
+            all(getattr(tfm, 'channel_invariant', False) for tfm in transforms or [])
+        self.num_workers = num_workers
+        self.epoch = 0
+
+    def get_rng(self, epoch):
+        """ Returns the random generator of an epoch: seeded if 'seed' is set, else the numpy.random module"""
+        if self.seed is None:
+            return np.random
+        return np.random.default_rng(np.random.SeedSequence([self.seed, epoch]))
+
+    def get_shard_order(self, epoch, rng):
+        """ Function to get the paths of the shards read in an epoch, in order"""
+        if self.shard is not None:
+            sizes = [os.path.getsize(path) for path in self.shards] if self.shard.balance == 'bytes' else None
+            return [self.shards[i] for i in self.shard.get_indices(epoch, len(self.shards), sizes)]
+        if not self.shuffle_shards:
+            return list(self.shards)
+        return [self.shards[i] for i in rng.permutation(len(self.shards))]
+
+    def iter_files(self, paths):
+        """ Generator of (ID, compressed bytes) for the image files of the tar files in 'paths', in order"""
+        for path in paths:
+            # 'r|' reads the archive as a stream, strictly sequentially
+            with tarfile.open(path, 'r|') as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    ID, suffix = os.path.splitext(member.name)
+                    if suffix.lower() not in IMAGE_SUFFIXES:
+                        continue
+                    yield ID, np.frombuffer(tar.extractfile(member).read(), dtype=np.uint8)
+
+    def shuffled(self, files, rng):
+        """ Generator drawing items of 'files' at random from a buffer of 'shuffle_buffer' items"""
+        if self.shuffle_buffer <= 1:
+            yield from files
+            return
+        buffer = []
+        for item in files:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            i = rng.integers(len(buffer)) if hasattr(rng, 'integers') else rng.randint(len(buffer))
+            buffer[i], item = item, buffer[i]
+            yield item
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def iter_compressed(self):
+        """ Function to start an epoch. Returns a generator of (ID, compressed bytes) in shuffled order."""
+        rng = self.get_rng(self.epoch)
+        paths = self.get_shard_order(self.epoch, rng)
+        self.epoch += 1
+        return self.shuffled(self.iter_files(paths), rng)
+
+    def process(self, data, out=None):
+        """ Function to decode compressed image contents, transform and format the image"""
+        img = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("Can't decode image")
+        if not self.keep_bgr:
+            #shift channels to convert to RGB
+            img = img[:, :, ::-1]
+        if self.transform_image:
+            # see ImageReader.process_image
+            img = self.transform_image(img, out if self.output is None else None, self.output is not None)
+        if self.output is not None:
+            return self.output(img, out, self.keep_bgr)
+        if out is not None and img is not out:
+            np.copyto(out, img)
+            return out
+        return img
+
+    def __iter__(self):
+        for ID, data in self.iter_compressed():
+            yield ID, self.process(data)
+
+    def iter_batches(self, batch_size, drop_last=False):
+        """
+        Function to iterate over one epoch in batches. Yields (IDs, batch) pairs, where batch is an array
+        of shape (N, ...) if every image has the same shape (e.g. the transforms end with a
+        Crop_and_resize(sz=...)) and a list of images otherwise.
+        With num_workers > 0, the images of a batch are decoded and transformed in parallel threads.
+        """
+        executor = cf.ThreadPoolExecutor(self.num_workers) if self.num_workers > 0 else None
+        try:
+            batch = []
+            for item in self.iter_compressed():
+                batch.append(item)
+                if len(batch) == batch_size:
+                    yield self.make_batch(batch, executor)
+                    batch = []
+            if batch and not drop_last:
+                yield self.make_batch(batch, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def make_batch(self, items, executor=None):
+        datas = [data for _, data in items]
+        images = list(executor.map(self.process, datas)) if executor is not None else list(map(self.process, datas))
+        IDs = [ID for ID, _ in items]
+        if all(img.shape == images[0].shape for img in images):
+            return IDs, np.stack(images)
+        return IDs, images
@@ -0,0 +1,182 @@
+import os
+import cv2
+import numpy as np
+from aug_transforms import apply_affine, resize_matrix, translate_matrix
+
+TILES_FILE = 'tiles.bin'
+PYRAMID_FILE = 'pyramid.npz'
+
+_LEVEL_DTYPE = np.dtype([('height', np.int32), ('width', np.int32), ('first_tile', np.int64),
+                         ('rows', np.int32), ('cols', np.int32)])
+
+def is_pyramid(path):
+    """ Returns True if 'path' is a directory written by pack_pyramid"""
+    return (os.path.isfile(os.path.join(path, TILES_FILE)) and
+            os.path.isfile(os.path.join(path, PYRAMID_FILE)))
+
+def get_level_shapes(shape, tile_size):
+    """ Function to get the (height, width) of each level of the pyramid of an image of the given shape"""
+    shapes = [tuple(shape[:2])]
+    while max(shapes[-1]) > tile_size:
+        h, w = shapes[-1]
+        shapes.append((max(h // 2, 1), max(w // 2, 1)))
+    return shapes
+
+def pack_pyramid(reader, out_dir, tile_size=256):
+    """
+    Function to decode every image of an ImageReader once and write it as a tiled pyramid: the image at
+    full resolution and downscaled by 2, 4, 8... until it fits in one tile, each level cut into square
+    tiles of tile_size x tile_size pixels. The directory can then be passed as 'root' to ImageReader,
+    which reads only the tiles needed for each crop. No transformations are applied.
+
+    Parameters
+    ----------
+    reader: An instance of ImageReader. All images in reader.file_ids are packed.
+
+    out_dir: Path to the directory to write. It is created if it does not exist.
+          The directory contains 'tiles.bin', the raw RGB uint8 pixels of every tile (tiles at the
+          right and bottom edges are padded with zeros), and 'pyramid.npz', the index of the levels.
+
+    tile_size: default = 256
+          Height and width of the tiles
+
+    Returns
+    -------
+    An instance of TiledPyramid opened on out_dir
+
+    Example Usage:
+    pack_pyramid(ImageReader(PATH_TO_SCANS), PATH_TO_PYRAMID, tile_size=256)
+    imr = ImageReader(PATH_TO_PYRAMID, transforms=[Horizontal_flip(), Crop_and_resize(0.9, sz=(512, 512))])
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    levels, level_starts = [], [0]
+    num_tiles = 0
+    with open(os.path.join(out_dir, TILES_FILE), 'wb') as f:
+        for ID in reader.file_ids:
+            img = np.ascontiguousarray(reader.decode_image(ID), dtype=np.uint8)
+            for i, (h, w) in enumerate(get_level_shapes(img.shape, tile_size)):
+                if i > 0:
+                    img = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+                rows, cols = -(-h // tile_size), -(-w // tile_size)
+                padded = np.zeros((rows * tile_size, cols * tile_size, 3), dtype=np.uint8)
+                padded[:h, :w] = img
+                # tile by tile, each tile contiguous
+                tiles = padded.reshape(rows, tile_size, cols, tile_size, 3).swapaxes(1, 2)
+                f.write(np.ascontiguousarray(tiles).data)
+                levels.append((h, w, num_tiles, rows, cols))
+                num_tiles += rows * cols
+            level_starts.append(len(levels))
+    np.savez(os.path.join(out_dir, PYRAMID_FILE), ids=np.asarray(reader.file_ids), tile_size=tile_size,
+             levels=np.array(levels, dtype=_LEVEL_DTYPE), level_starts=np.array(level_starts, dtype=np.int64))
+    return TiledPyramid(out_dir)
+
+class TiledPyramid(object):
+    """
+    This class provides read access to a directory written by pack_pyramid.
+    The tiles are memory mapped, so reading a region of an image only reads the tiles it intersects.
+    'read_affine' picks the coarsest level that still has enough resolution for the output, so the
+    memory and I/O per image scale with the size of the output rather than with the size of the image.
+
+    Parameters
+    ----------
+    path: Path to a directory written by pack_pyramid
+
+    Example Usage:
+    pyramid = TiledPyramid(PATH_TO_PYRAMID)
+    region = pyramid.read_region(pyramid.ids[0], 0, (0, 512, 0, 512))
+    """
+    def __init__(self, path):
+        self.path = path
+        self._open()
+
+    def _open(self):
+        index = np.load(os.path.join(self.path, PYRAMID_FILE))
+        self.ids = index['ids']
+        self.tile_size = int(index['tile_size'])
+        self.levels = index['levels']
+        self.level_starts = index['level_starts']
+        self.positions = {ID: i for i, ID in enumerate(self.ids)}
+        t = self.tile_size
+        num_tiles = int(self.levels['first_tile'][-1] + self.levels['rows'][-1] * self.levels['cols'][-1]) \
+            if len(self.levels) else 0
+        if num_tiles:
+            self.tiles = np.memmap(os.path.join(self.path, TILES_FILE), dtype=np.uint8, mode='r',
+                                   shape=(num_tiles, t, t, 3)).view(np.ndarray)
+        else:
+            self.tiles = np.zeros((0, t, t, 3), dtype=np.uint8)
+
+    def __getstate__(self):
+        # reopen the mapping instead of pickling the pixels
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_levels(self, ID):
+        """ Returns the index entries of the levels of an image, from full resolution down"""
+        i = self.positions[ID]
+        return self.levels[self.level_starts[i]:self.level_starts[i + 1]]
+
+    def get_shape(self, ID):
+        """ Returns the (height, width, channels) of an image at full resolution"""
+        level = self.get_levels(ID)[0]
+        return int(level['height']), int(level['width']), 3
+
+    def read_region(self, ID, level, box, out=None):
+        """
+        Function to read the pixels of box = (top, bottom, left, right) of a level of an image,
+        touching only the tiles that intersect it. The box has to lie inside the level.
+        """
+        entry = self.get_levels(ID)[level]
+        top, bottom, left, right = box
+        t = self.tile_size
+        if out is None:
+            out = np.empty((bottom - top, right - left, 3), dtype=np.uint8)
+        for row in range(top // t, (bottom - 1) // t + 1):
+            for col in range(left // t, (right - 1) // t + 1):
+                tile = self.tiles[entry['first_tile'] + row * entry['cols'] + col]
+                y0, y1 = max(top, row * t), min(bottom, (row + 1) * t)
+                x0, x1 = max(left, col * t), min(right, (col + 1) * t)
+                out[y0 - top:y1 - top, x0 - left:x1 - left] = tile[y0 - row * t:y1 - row * t,
+                                                                   x0 - col * t:x1 - col * t]
+        return out
+
+    def get(self, ID):
+        """ Returns the full resolution image with the given ID"""
+        h, w, _ = self.get_shape(ID)
+        return self.read_region(ID, 0, (0, h, 0, w))
+
+    def read_affine(self, ID, matrix, out_shape):
+        """
+        Function to resample an image with a 3x3 affine matrix (see aug_transforms.apply_affine) from the
+        coarsest level with at least as many pixels per output pixel as the full image along both axes,
+        only reading the part of that level the output maps to.
+        """
+        levels = self.get_levels(ID)
+        full = (int(levels[0]['height']), int(levels[0]['width']))
+        h, w = out_shape
+        inverse = np.linalg.inv(matrix)
+        # pixel edges of the output mapped back to the full resolution image
+        corners = inverse @ np.array([[-0.5, w - 0.5, -0.5, w - 0.5], [-0.5, -0.5, h - 0.5, h - 0.5], [1, 1, 1, 1]])
+        # output pixels per input pixel, along the most shrunk direction
+        scale = np.linalg.svd(matrix[:2, :2], compute_uv=False).min()
+        level = 0
+        while level + 1 < len(levels) and scale * 2 ** (level + 1) <= 1 + 1e-9:
+            level += 1
+        entry = levels[level]
+        shape = (int(entry['height']), int(entry['width']))
+        to_level = resize_matrix(full, shape)
+        corners = to_level @ corners
+        # one pixel of margin for the interpolation
+        top = int(np.clip(np.floor(corners[1].min()) - 1, 0, shape[0]))
+        bottom = int(np.clip(np.ceil(corners[1].max()) + 2, 0, shape[0]))
+        left = int(np.clip(np.floor(corners[0].min()) - 1, 0, shape[1]))
+        right = int(np.clip(np.ceil(corners[0].max()) + 2, 0, shape[1]))
+        if bottom <= top or right <= left:
+            return np.zeros((h, w, 3), dtype=np.uint8)
+        region = self.read_region(ID, level, (top, bottom, left, right))
+        return apply_affine(region, matrix @ np.linalg.inv(to_level) @ translate_matrix(left, top), out_shape)
@@ -1,4 +1,62 @@
+import time
+import threading
+import cv2
 import numpy as np
+from aug_transforms import apply_affine, apply_lut, apply_affine_batch, apply_luts, identity_luts
+
+# estimated costs in ns per pixel, used by Transformer.estimate_cost: transformations without a
+# 'pixel_cost' attribute, and resampling by apply_affine (warpAffine per output pixel, resize per pixel
+# of the larger of input and output, flips and crops per output pixel)
+DEFAULT_PIXEL_COST = 10
+WARP_PIXEL_COST = 15
+RESIZE_PIXEL_COST = 6
+COPY_PIXEL_COST = 0.6
+
+def make_sample_image(shape, seed=0):
+    """ Function to make a smooth random RGB uint8 image of shape (height, width), which resamples like a photo"""
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    small = rng.integers(0, 256, (max(h // 16, 2), max(w // 16, 2), 3), dtype=np.uint8)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+
+class ScratchBuffers(object):
+    """
+    Two buffers that the stages of a Transformer write their outputs into in turn ('ping-pong'): each stage
+    reads the image from one buffer and writes to the other. The buffers grow to the largest image they are
+    asked to hold and are then reused, so once they have, intermediate images need no allocation.
+    """
+    def __init__(self):
+        self.buffers = [np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.uint8)]
+    
+    def index(self, img):
+        """ Returns the index of the buffer holding 'img', or None if it isn't held by either"""
+        for i, buf in enumerate(self.buffers):
+            if img.base is buf:
+                return i
+        return None
+    
+    def get(self, i, shape, dtype):
+        """ Returns buffer i as an array of the given shape and dtype"""
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        if self.buffers[i].nbytes < nbytes:
+            self.buffers[i] = np.empty(nbytes, dtype=np.uint8)
+        return self.buffers[i][:nbytes].view(dtype).reshape(shape)
+    
+    def get_output(self, img, shape, dtype, in_place=False, out=None):
+        """
+        Returns the array a stage transforming 'img' should write its output of the given shape and dtype
+        into: 'out' if it fits, 'img' itself if the stage can work in place and 'img' is a scratch buffer,
+        or else the scratch buffer not holding 'img'.
+        """
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if out is not None and out.shape == shape and out.dtype == dtype:
+            return out
+        current = self.index(img)
+        if in_place and current is not None and img.shape == shape and img.dtype == dtype:
+            return img
+        return self.get(0 if current is None else 1 - current, shape, dtype)
+
 class Transformer(object):
     """
     This class provides callable instances that apply specified transformations to images.
@@ -21,12 +79,25 @@ class Transformer(object):
                 If set to 'True', then a subset of the transformations in 'transforms' is applied to the image
                 A boolean array can be passed of length len(transforms) specifying the randomy behaviour for each
                 transform separately
-                
+    
+    fuse: default = True
+                If set to 'True', consecutive geometric transformations (any object with a 'get_affine' method,
+                such as Horizontal_flip, Vertical_flip, Rotate_rand and Crop_and_resize) are combined into a
+                single affine matrix, and the image is resampled once, directly at the output resolution.
+                Likewise, consecutive pixel-wise transformations with a 'get_lut' method (Brightness, Contrast)
+                are combined into a single 256 entry lookup table applied in one pass.
+                If set to 'False', each transformation is applied separately.
+    
+    profiler: default = None
+                Optionally, a Profiler instance to record the time taken by each stage and how often each
+                transformation modifies the image. See 'Profiler'.
     
     Returns
     -------
     A callable instance that acts as an image transformation function.
     The functions takes in as argument an image of type numpy.ndarray and returns an image of the same type
+    A batch of images of shape (N, H, W, C) can also be passed, in which case each image is transformed
+    independently, see 'apply_batch'.
     
     Example Usage:
     transforms = [Horizontal_flip(), Gaussian_blur(amount=3), 
@@ -35,16 +106,44 @@ class Transformer(object):
     
     image = cv2.imread(PATH_TO_IMAGE)
     transformed_image = transformer_object(image)
+    
+    Buffers: a preallocated array 'out' can be passed as second argument to receive the transformed image.
+    Intermediate images are written into two scratch buffers per thread (see 'ScratchBuffers') by the
+    transformations that accept an 'out' argument and have a 'get_output_spec' method (all transformations
+    in aug_transforms), and the last stage writes directly into 'out'. Transforming images of similar sizes
+    then allocates no image memory once the buffers have grown. Without 'out', the result is a new array.
     """
-    def __init__(self, transforms, randomize_transforms=False):
+    def __init__(self, transforms, randomize_transforms=False, fuse=True, profiler=None):
         self.transforms = list(transforms)
         self.randomize = randomize_transforms
+        self.fuse = fuse
+        self.profiler = profiler
         try:
             self.len = len(self.transforms)
         except:
             self.len = 1
         self.do_ops = self.get_do_ops()
-
+        self.stages = self.get_stages()
+        self.stage_names = ['+'.join(type(self.transforms[i]).__name__ for i in stage) for _, stage in self.stages]
+        self.plan_dtype = self.get_plan_dtype()
+        self._local = threading.local()
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+    
+    def get_scratch(self):
+        """ Function to get the ScratchBuffers of the calling thread"""
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            scratch = self._local.scratch = ScratchBuffers()
+        return scratch
+    
     def get_do_ops(self):
         if self.randomize == True:
             return np.zeros(self.len, dtype=np.uint8)
@@ -53,9 +152,482 @@ class Transformer(object):
         elif len(self.randomize) == self.len:
             return self.randomize
         
-    def __call__(self, img):
+    def get_stages(self):
+        """
+        Function to group the transformations into stages. Each stage is a tuple (kind, indices) where
+        'indices' index into 'transforms'. When 'fuse' is set, consecutive geometric transformations form
+        a single stage of kind 'affine', and consecutive transformations with a 'get_lut' method (such as
+        Brightness and Contrast) form a single stage of kind 'lut'. Other stages have kind None.
+        """
+        stages = []
+        for i, tfm in enumerate(self.transforms):
+            kind = None
+            if self.fuse and hasattr(tfm, 'get_affine'):
+                kind = 'affine'
+            elif self.fuse and hasattr(tfm, 'get_lut'):
+                kind = 'lut'
+            if kind is not None and stages and stages[-1][0] == kind:
+                stages[-1][1].append(i)
+            else:
+                stages.append((kind, [i]))
+        return stages
+    
+    def apply_geometric(self, transforms, img, scratch=None, out=None):
+        """
+        Function to apply a list of geometric transformations with a single resampling of 'img'.
+        With 'scratch', the output is written as given by ScratchBuffers.get_output.
+        """
+        matrix, shape = None, img.shape[:2]
+        for tfm in transforms:
+            op_matrix, shape = tfm.get_affine(shape)
+            if self.profiler is not None:
+                self.profiler.count(type(tfm).__name__, op_matrix is not None)
+            if op_matrix is not None:
+                matrix = op_matrix if matrix is None else op_matrix @ matrix
+        if matrix is None:
+            return img
+        if scratch is not None:
+            out = scratch.get_output(img, tuple(shape) + img.shape[2:], img.dtype, False, out)
+        return apply_affine(img, matrix, shape, out)
+    
+    def apply_photometric(self, transforms, img, scratch=None, out=None):
+        """ Function to apply a list of pixel-wise transformations as a single lookup table on a uint8 image"""
+        lut = None
+        for tfm in transforms:
+            op_lut = tfm.get_lut()
+            if self.profiler is not None:
+                self.profiler.count(type(tfm).__name__, op_lut is not None)
+            if op_lut is not None:
+                lut = op_lut if lut is None else op_lut[lut]
+        if lut is None:
+            return img
+        if scratch is not None:
+            out = scratch.get_output(img, img.shape, np.uint8, True, out)
+        return apply_lut(img, lut, out)
+    
+    def apply_geometric_batch(self, transforms, masks, batch, scratch=None, out=None):
+        """ Batch version of apply_geometric: one affine matrix and one resampling per image"""
+        n = len(batch)
+        matrices, shape = None, batch.shape[1:3]
+        for tfm, mask in zip(transforms, masks):
+            op_matrices, shape = tfm.get_affines(shape, n, mask)
+            matrices = op_matrices if matrices is None else op_matrices @ matrices
+        if scratch is not None:
+            out = scratch.get_output(batch, (n,) + tuple(shape) + batch.shape[3:], batch.dtype, False, out)
+        return apply_affine_batch(batch, matrices, shape, out)
+    
+    def apply_photometric_batch(self, transforms, masks, batch, scratch=None, out=None):
+        """ Batch version of apply_photometric: one lookup table per image, applied in one pass"""
+        n = len(batch)
+        rows = np.arange(n)[:, None]
+        luts = identity_luts(n)
+        for tfm, mask in zip(transforms, masks):
+            luts = tfm.get_luts(n, mask)[rows, luts]
+        if scratch is not None:
+            out = scratch.get_output(batch, batch.shape, np.uint8, True, out)
+        return apply_luts(batch, luts, out)
+    
+    def apply_batch(self, batch, out=None):
+        """
+        Function to transform each image of a batch of shape (N, H, W, C) independently.
+        Transformations with an 'apply_batch' method (all transformations in aug_transforms) draw their
+        random parameters for the whole batch at once and are applied to all images together. Other
+        transformations are called on each image in turn.
+        Like single images, the stages write into the scratch buffers in turn, and the last one into
+        'out' if given (see 'Buffers' above).
+        """
+        operations = (np.random.randint(0, 2, (len(batch), self.len)) + self.do_ops) > 0
+        num_stages = len(self.stages)
+        for s, (name, (kind, stage)) in enumerate(zip(self.stage_names, self.stages)):
+            transforms = [self.transforms[i] for i in stage]
+            masks = [operations[:, i] for i in stage]
+            if self.profiler is not None:
+                start = time.perf_counter()
+            # size changing transformations (e.g. Crop_and_resize to 'sz') resize every image
+            if not any(mask.any() for mask in masks) and all(
+                    tfm.get_output_spec(batch.shape[1:], batch.dtype)[0] == batch.shape[1:]
+                    for tfm in transforms if hasattr(tfm, 'get_output_spec')):
+                continue
+            scratch, stage_out = self.get_stage_buffers(s, num_stages, out)
+            if kind == 'affine' and len(stage) > 1:
+                batch = self.apply_geometric_batch(transforms, masks, batch, scratch, stage_out)
+            elif kind == 'lut' and len(stage) > 1:
+                batch = self.apply_photometric_batch(transforms, masks, batch, scratch, stage_out)
+            elif hasattr(transforms[0], 'apply_batch') and hasattr(transforms[0], 'get_output_spec'):
+                dst = stage_out
+                if scratch is not None:
+                    shape, dtype = transforms[0].get_output_spec(batch.shape[1:], batch.dtype)
+                    dst = scratch.get_output(batch, (len(batch),) + tuple(shape), dtype,
+                                             getattr(transforms[0], 'in_place', False), stage_out)
+                batch = transforms[0].apply_batch(batch, masks[0], dst)
+            elif hasattr(transforms[0], 'apply_batch'):
+                batch = transforms[0].apply_batch(batch, masks[0])
+            else:
+                batch = np.stack([transforms[0](img) if do_op else img for img, do_op in zip(batch, masks[0])])
+            if self.profiler is not None:
+                self.profiler.record(name, time.perf_counter() - start)
+        return self.finish(batch, out)
+    
+    def call_transform(self, tfm, img, scratch=None, out=None, params=None, in_place=True):
+        """
+        Function to call a single transformation (or its 'apply_params' method with 'params') on an image.
+        With 'scratch', transformations following the buffer protocol write their output as given by
+        ScratchBuffers.get_output, in place if they support it, unless 'in_place' is False.
+        """
+        if scratch is not None and hasattr(tfm, 'get_output_spec'):
+            shape, dtype = tfm.get_output_spec(img.shape, img.dtype)
+            in_place = in_place and getattr(tfm, 'in_place', False)
+            dst = scratch.get_output(img, shape, dtype, in_place, out)
+            return tfm(img, dst) if params is None else tfm.apply_params(img, params, dst)
+        if params is None:
+            return tfm(img)
+        return tfm.apply_params(img, params) if hasattr(tfm, 'apply_params') else tfm(img)
+    
+    def apply_stage(self, kind, stage, operations, img, scratch=None, out=None):
+        """
+        Function to apply one stage (see 'get_stages') to an image.
+        With 'scratch', the output is written into 'out' or a scratch buffer, see ScratchBuffers.get_output.
+        """
+        if kind is None or len(stage) == 1:
+            tfm = self.transforms[stage[0]]
+            if not operations[stage[0]]:
+                result, fired = img, False
+            else:
+                # transformations return 'img' exactly when they don't fire, so when profiling, in place ones
+                # write into the other scratch buffer instead of 'img' to tell
+                result = self.call_transform(tfm, img, scratch, out, in_place=self.profiler is None)
+                fired = result is not img
+            if self.profiler is not None:
+                self.profiler.count(type(tfm).__name__, fired)
+            return result
+        if self.profiler is not None:
+            for i in stage:
+                if not operations[i]:
+                    self.profiler.count(type(self.transforms[i]).__name__, False)
+        if kind == 'affine':
+            return self.apply_geometric([self.transforms[i] for i in stage if operations[i]], img, scratch, out)
+        return self.apply_photometric([self.transforms[i] for i in stage if operations[i]], img, scratch, out)
+    
+    def get_stage_buffers(self, s, num_stages, out=None, temporary=False):
+        """
+        Function to get the (scratch, out) arguments of stage s of num_stages. The last stage writes into
+        'out', or into a new array if there is no 'out', unless 'temporary' is set.
+        """
+        if s < num_stages - 1:
+            return self.get_scratch(), None
+        if out is None and not temporary:
+            return None, None
+        return self.get_scratch(), out
+    
+    def finish(self, img, out=None, temporary=False):
+        """ Function to move the result of the last stage into 'out', or out of the scratch buffers"""
+        if out is not None and img is not out:
+            if img.shape != out.shape:
+                raise ValueError("The transformed image has shape %s but 'out' has shape %s" % (img.shape, out.shape))
+            np.copyto(out, img, casting='unsafe')
+            return out
+        if out is None and not temporary and self.get_scratch().index(img) is not None:
+            return img.copy()
+        return img
+    
+    def __call__(self, img, out=None, temporary=False):
+        """
+        Function to transform an image (or a batch, see 'apply_batch'). If 'out' is given, the result is
+        written into it. If 'temporary' is set, the result may be held in a scratch buffer, so it is only
+        valid until the next call from the same thread.
+        """
+        if img.ndim == 4:
+            return self.apply_batch(img, out)
         operations = np.random.randint(0, 2, self.len) + self.do_ops
+        num_stages = len(self.stages)
+        for s, (name, (kind, stage)) in enumerate(zip(self.stage_names, self.stages)):
+            if self.profiler is not None:
+                start = time.perf_counter()
+            scratch, stage_out = self.get_stage_buffers(s, num_stages, out, temporary)
+            img = self.apply_stage(kind, stage, operations, img, scratch, stage_out)
+            if self.profiler is not None:
+                self.profiler.record(name, time.perf_counter() - start)
+        return self.finish(img, out, temporary)
+    
+    def get_plan_dtype(self):
+        """
+        Function to build the numpy structured dtype of one sample of an augmentation plan.
+        The field 't<i>' holds the parameters of transforms[i]: 'fire' tells if the transformation is
+        applied, followed by the fields listed in its 'plan_fields' attribute.
+        """
+        return np.dtype([('t%d' % i, [('fire', bool)] + list(getattr(tfm, 'plan_fields', [])))
+                         for i, tfm in enumerate(self.transforms)])
+    
+    def make_plan(self, n, rng):
+        """
+        Function to sample the augmentation parameters of n images up front.
+        
+        Parameters
+        ----------
+        n: Number of images
+        
+        rng: An instance of numpy.random.Generator used for all random draws
+        
+        Returns
+        -------
+        A structured array of length n and dtype 'plan_dtype'. Row i can be passed to 'apply_plan'
+        to transform image i, and gives the exact same result every time.
+        Transformations without a 'sample_params' method only get a 'fire' flag; when they fire,
+        they are called normally and use the global numpy random state.
+        """
+        plan = np.zeros(n, dtype=self.plan_dtype)
+        operations = (rng.integers(0, 2, (n, self.len)) + self.do_ops) > 0
+        for i, tfm in enumerate(self.transforms):
+            params = plan['t%d' % i]
+            if hasattr(tfm, 'sample_params'):
+                for name, values in tfm.sample_params(rng, n).items():
+                    params[name] = values
+                params['fire'] &= operations[:, i]
+            else:
+                params['fire'] = operations[:, i]
+        return plan
+    
+    def make_epoch_plan(self, n, seed, num_streams=1):
+        """
+        Function to sample the augmentation plan of a whole epoch of n images.
+        The images are split in 'num_streams' contiguous chunks, and each chunk is sampled from its own
+        independent numpy.random.Generator spawned from 'seed' (an integer or numpy.random.SeedSequence).
+        The result only depends on 'seed', 'n' and 'num_streams', so any sample can be replayed exactly.
+        """
+        seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        chunks = np.array_split(np.arange(n), num_streams)
+        return np.concatenate([self.make_plan(len(chunk), np.random.default_rng(stream))
+                               for chunk, stream in zip(chunks, seed.spawn(num_streams))])
+    
+    def plan_matrix(self, stage, shape, params):
+        """ Function to compose the affine matrices of a geometric stage for one sample of a plan"""
+        matrix = None
+        for i in stage:
+            op_matrix, shape = self.transforms[i].affine_from_params(shape, params['t%d' % i])
+            if op_matrix is not None:
+                matrix = op_matrix if matrix is None else op_matrix @ matrix
+        return (np.eye(3) if matrix is None else matrix), shape
+    
+    def plan_lut(self, stage, params):
+        """ Function to compose the lookup tables of a pixel-wise stage for one sample of a plan"""
+        lut = np.arange(256, dtype=np.uint8)
+        for i in stage:
+            op_lut = self.transforms[i].lut_from_params(params['t%d' % i])
+            if op_lut is not None:
+                lut = op_lut[lut]
+        return lut
+    
+    def get_plan_stages(self):
+        """ Same as 'stages', with stages that can't be fused from plan parameters split up"""
+        required = {'affine': 'affine_from_params', 'lut': 'lut_from_params'}
+        stages = []
+        for kind, stage in self.stages:
+            if kind is not None and len(stage) > 1 and \
+                    all(hasattr(self.transforms[i], required[kind]) for i in stage):
+                stages.append((kind, stage))
+            else:
+                stages.extend((None, [i]) for i in stage)
+        return stages
+    
+    def apply_params(self, i, img, params, scratch=None, out=None):
+        if not params['fire']:
+            return img
+        return self.call_transform(self.transforms[i], img, scratch, out, params)
+    
+    def apply_plan(self, img, params, out=None, temporary=False):
+        """
+        Function to transform an image with one sample 'params' of a plan made by 'make_plan'.
+        See '__call__' for 'out' and 'temporary'.
+        """
+        stages = self.get_plan_stages()
+        for s, (kind, stage) in enumerate(stages):
+            scratch, stage_out = self.get_stage_buffers(s, len(stages), out, temporary)
+            if kind == 'affine':
+                matrix, shape = self.plan_matrix(stage, img.shape[:2], params)
+                if tuple(shape) == img.shape[:2] and (matrix == np.eye(3)).all():
+                    continue
+                if scratch is not None:
+                    stage_out = scratch.get_output(img, tuple(shape) + img.shape[2:], img.dtype, False, stage_out)
+                img = apply_affine(img, matrix, shape, stage_out)
+            elif kind == 'lut':
+                if scratch is not None:
+                    stage_out = scratch.get_output(img, img.shape, np.uint8, True, stage_out)
+                img = apply_lut(img, self.plan_lut(stage, params), stage_out)
+            else:
+                img = self.apply_params(stage[0], img, params['t%d' % stage[0]], scratch, stage_out)
+        return self.finish(img, out, temporary)
+    
+    def apply_plan_batch(self, batch, plan):
+        """
+        Function to transform a batch of shape (N, H, W, C) with the N samples of a plan.
+        Images with the same set of firing transformations are processed together, so within a group
+        each stage is applied to all images at once without checking which transformations fire.
+        """
+        stages = self.get_plan_stages()
+        fired = np.stack([plan['t%d' % i]['fire'] for i in range(self.len)], axis=1)
+        keys, groups = np.unique(fired, axis=0, return_inverse=True)
+        out = None
+        for key, group in zip(keys, range(len(keys))):
+            idx = np.flatnonzero(groups.reshape(-1) == group)
+            images, params = batch[idx], plan[idx]
+            for kind, stage in stages:
+                stage = [i for i in stage if key[i]]
+                if not stage:
+                    continue
+                elif kind == 'affine':
+                    matrices = [self.plan_matrix(stage, images.shape[1:3], p) for p in params]
+                    images = apply_affine_batch(images, np.stack([m for m, _ in matrices]), matrices[0][1])
+                elif kind == 'lut':
+                    images = apply_luts(images, np.stack([self.plan_lut(stage, p) for p in params]))
+                else:
+                    images = np.stack([self.apply_params(stage[0], img, p['t%d' % stage[0]])
+                                       for img, p in zip(images, params)])
+            if out is None:
+                out = np.empty((len(batch),) + images.shape[1:], dtype=images.dtype)
+            elif images.shape[1:] != out.shape[1:]:
+                raise ValueError("The plan produces images of different shapes %s and %s"
+                                 % (images.shape[1:], out.shape[1:]))
+            out[idx] = images
+        return out
+    
+    def subset(self, order):
+        """ Function to get a Transformer applying transforms[i] for i in 'order', in that order"""
+        randomize = self.randomize
+        if not isinstance(randomize, bool):
+            randomize = [self.randomize[i] for i in order]
+        return Transformer([self.transforms[i] for i in order], randomize, self.fuse, self.profiler)
+    
+    def permute_plan(self, plan, order):
+        """ Function to convert a plan of this Transformer to one of subset(order)"""
+        permuted = np.zeros(len(plan), dtype=self.subset(order).plan_dtype)
+        for j, i in enumerate(order):
+            permuted['t%d' % j] = plan['t%d' % i]
+        return permuted
+    
+    def estimate_cost(self, shape, num_samples=64, plan=None):
+        """
+        Function to estimate the time taken to transform one image of shape (height, width), in microseconds,
+        averaged over 'num_samples' samples of the transformations' parameters (see 'make_plan'), or over
+        the samples of 'plan' if given.
+        Pixel-wise stages cost the 'pixel_cost' attribute of their transformations (in ns per pixel, the
+        highest one for a fused stage) times the number of pixels. Geometric stages cost the resampling done
+        by apply_affine for the composed matrix (see WARP_PIXEL_COST, RESIZE_PIXEL_COST and COPY_PIXEL_COST).
+        Returns (total, list of (stage name, cost) pairs).
+        """
+        if plan is None:
+            plan = self.make_plan(num_samples, np.random.default_rng(0))
+        costs = np.zeros(len(self.stages))
+        for params in plan:
+            size = tuple(shape[:2])
+            for s, (kind, stage) in enumerate(self.stages):
+                fired = [i for i in stage if params['t%d' % i]['fire']]
+                if not fired:
+                    continue
+                if all(hasattr(self.transforms[i], 'affine_from_params') for i in stage):
+                    matrix, out = self.plan_matrix(fired, size, params)
+                    if matrix[0, 1] != 0 or matrix[1, 0] != 0:
+                        costs[s] += WARP_PIXEL_COST * out[0] * out[1]
+                    elif tuple(out) != size or abs(matrix[0, 0]) != 1 or abs(matrix[1, 1]) != 1:
+                        costs[s] += RESIZE_PIXEL_COST * max(out[0] * out[1], size[0] * size[1])
+                    else:
+                        costs[s] += COPY_PIXEL_COST * out[0] * out[1]
+                    size = tuple(out)
+                else:
+                    pixel_cost = max(getattr(self.transforms[i], 'pixel_cost', DEFAULT_PIXEL_COST) for i in fired)
+                    costs[s] += pixel_cost * size[0] * size[1]
+        costs = costs / len(plan) / 1e3
+        return float(costs.sum()), [(name, float(cost)) for name, cost in zip(self.stage_names, costs)]
+    
+    def compile(self, shape, tolerance=0, sample=None, num_samples=8, verbose=False):
+        """
+        Function to optimize the order of the transformations for images of shape (height, width).
+        - transformations that can never change an image (an 'is_identity' method returning True,
+          e.g. Gaussian_blur(amount=1)) are removed
+        - pixel-wise transformations ('pointwise' set, e.g. Brightness, Contrast, Color_jitter) and linear
+          filters ('linear_filter' set, e.g. Gaussian_blur) are moved across neighbouring geometric
+          transformations when that lowers the estimated cost (see 'estimate_cost'): after a downscaling
+          Crop_and_resize, or before an upscaling one.
+        They keep their order relative to each other. Since resampling before or after a pixel-wise
+        transformation rounds differently, each move is checked on 'sample' (or a synthetic image):
+        both orders are applied with the same 'num_samples' plan samples, with every transformation firing, and
+        the move is kept only if the mean absolute difference (in uint8 levels) is at most 'tolerance'.
+        Random noise, as drawn by Color_jitter, differs once the image size changes, so such moves need a
+        tolerance around the noise amplitude. A filter's kernel is sized in pixels, so moving it across a
+        resize changes its extent in the image: these moves usually only pass with a large tolerance, while
+        moves across flips are exact.
+        Every transformation needs the plan methods (see 'make_plan') to be moved.
+        
+        Returns
+        -------
+        A new Transformer, with a 'report' attribute: a dict with the estimated cost per image (in microseconds)
+        'cost_before' and 'cost_after', the 'removed' transformations, the 'moved' ones as
+        (name, old position, new position, error) and the new 'order' of the original indices.
+        """
+        shape = tuple(shape[:2])
+        img = make_sample_image(shape) if sample is None else sample
+        # all candidate orders are costed on the same samples, so that they are compared fairly
+        cost_plan = self.make_plan(64, np.random.default_rng(0))
+        plan = self.make_plan(num_samples, np.random.default_rng(1))
         for i in range(self.len):
-            if operations[i]:
-                img = self.transforms[i](img)
-        return img
\ No newline at end of file
+            plan['t%d' % i]['fire'] = True
+        expected = [self.apply_plan(img, params) for params in plan]
+        
+        def estimate(order):
+            return self.subset(order).estimate_cost(shape, plan=self.permute_plan(cost_plan, order))[0]
+        
+        def error(order):
+            candidate = self.subset(order)
+            errors = []
+            for params, ref in zip(self.permute_plan(plan, order), expected):
+                out = candidate.apply_plan(img, params)
+                if out.shape != ref.shape:
+                    return np.inf
+                errors.append(np.abs(out.astype(np.float32) - ref).mean())
+            return float(max(errors))
+        
+        identity = [i for i, tfm in enumerate(self.transforms) if hasattr(tfm, 'is_identity') and tfm.is_identity()]
+        order = [i for i in range(self.len) if i not in identity]
+        cost = estimate(order)
+        movable = all(hasattr(tfm, 'sample_params') for tfm in self.transforms)
+        moved = []
+        while movable:
+            candidates = []
+            for pos, i in enumerate(order):
+                tfm = self.transforms[i]
+                if not (getattr(tfm, 'pointwise', False) or getattr(tfm, 'linear_filter', False)):
+                    continue
+                # positions reachable by crossing geometric transformations only
+                lo = pos
+                while lo > 0 and hasattr(self.transforms[order[lo - 1]], 'get_affine'):
+                    lo -= 1
+                hi = pos
+                while hi < len(order) - 1 and hasattr(self.transforms[order[hi + 1]], 'get_affine'):
+                    hi += 1
+                rest = order[:pos] + order[pos + 1:]
+                for new in range(lo, hi + 1):
+                    if new != pos:
+                        candidate = rest[:new] + [i] + rest[new:]
+                        candidates.append((estimate(candidate), candidate, i, pos, new))
+            best = None
+            for new_cost, candidate, i, pos, new in sorted(candidates, key=lambda c: c[0]):
+                if new_cost >= cost * (1 - 1e-6):
+                    break
+                err = error(candidate)
+                if err <= tolerance:
+                    best = new_cost, candidate, (type(self.transforms[i]).__name__, pos, new, err)
+                    break
+            if best is None:
+                break
+            cost, order, move = best
+            moved.append(move)
+        optimized = self.subset(order)
+        optimized.report = {'cost_before': estimate(list(range(self.len))), 'cost_after': cost,
+                            'removed': [type(self.transforms[i]).__name__ for i in identity],
+                            'moved': moved, 'order': order}
+        if verbose:
+            print('estimated cost per image: %.1f us -> %.1f us' % (optimized.report['cost_before'], cost))
+            for name in optimized.report['removed']:
+                print('removed %s (no-op)' % name)
+            for name, pos, new, err in moved:
+                print('moved %s from position %d to %d (error %.3f)' % (name, pos, new, err))
+        return optimized
@@ -1,6 +1,172 @@
+import copy
+import threading
 import numpy as np
 import cv2
 
+def apply_affine(img, matrix, out_shape, out=None):
+    """
+    Function to resample an image with a 3x3 affine matrix that maps input pixel coordinates (x, y)
+    to output pixel coordinates, producing an image of shape out_shape = (height, width).
+    If the matrix only flips, crops and scales along the axes on whole-pixel boundaries, the image is
+    cropped as a view, resized with cv2.resize (INTER_AREA when shrinking) and flipped. Otherwise a
+    single cv2.warpAffine with bilinear interpolation is used, after shrinking the part of the image
+    it reads with INTER_AREA if it scales down by more than 2. The dtype of the image is preserved.
+    If 'out' is given, the result is written into it.
+    """
+    h, w = out_shape
+    if matrix[0, 1] == 0 and matrix[1, 0] == 0:
+        # pixel edges of the output mapped back to the input
+        xs = np.sort((np.array([-0.5, w - 0.5]) - matrix[0, 2]) / matrix[0, 0]) + 0.5
+        ys = np.sort((np.array([-0.5, h - 0.5]) - matrix[1, 2]) / matrix[1, 1]) + 0.5
+        edges = np.concatenate([ys, xs])
+        rounded = np.round(edges)
+        if (np.abs(edges - rounded) < 1e-6).all() and rounded[0] >= 0 and rounded[2] >= 0 \
+                and rounded[1] <= img.shape[0] and rounded[3] <= img.shape[1]:
+            top, bottom, left, right = rounded.astype(int)
+            img = img[top:bottom, left:right]
+            if img.shape[:2] != (h, w):
+                interp_method = cv2.INTER_AREA if h * w < img.shape[0] * img.shape[1] else cv2.INTER_LINEAR
+                img = cv2.resize(img, (w, h), dst=out, interpolation=interp_method)
+            flip_x, flip_y = matrix[0, 0] < 0, matrix[1, 1] < 0
+            if flip_x or flip_y:
+                img = cv2.flip(img, -1 if flip_x and flip_y else (1 if flip_x else 0), dst=out)
+            elif out is not None and img is not out:
+                np.copyto(out, img)
+                img = out
+            return img
+    # output pixels per input pixel along x and y: bilinear interpolation aliases below about 0.5
+    scales = np.hypot(matrix[0, :2], matrix[1, :2])
+    if (scales < 0.5).any():
+        img, matrix = shrink_for_warp(img, matrix, out_shape, np.minimum(2 * scales, 1))
+    return cv2.warpAffine(img, matrix[:2], (w, h), dst=out, flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def shrink_for_warp(img, matrix, out_shape, factors):
+    """
+    Function to downscale the part of an image that an affine matrix maps to the output by 'factors' = (x, y)
+    with cv2.resize and INTER_AREA, so that a bilinear warpAffine of the result doesn't alias.
+    Returns the shrunk region and the matrix mapping it to the output.
+    """
+    h, w = out_shape
+    corners = np.linalg.inv(matrix) @ np.array([[-0.5, w - 0.5, -0.5, w - 0.5], [-0.5, -0.5, h - 0.5, h - 0.5],
+                                                [1, 1, 1, 1]])
+    # one pixel of margin for the interpolation
+    top = int(np.clip(np.floor(corners[1].min()) - 1, 0, img.shape[0]))
+    bottom = int(np.clip(np.ceil(corners[1].max()) + 2, 0, img.shape[0]))
+    left = int(np.clip(np.floor(corners[0].min()) - 1, 0, img.shape[1]))
+    right = int(np.clip(np.ceil(corners[0].max()) + 2, 0, img.shape[1]))
+    if bottom <= top or right <= left:
+        return img, matrix
+    region = img[top:bottom, left:right]
+    shape = (max(int(round(region.shape[0] * factors[1])), 1), max(int(round(region.shape[1] * factors[0])), 1))
+    region = cv2.resize(region, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    to_region = resize_matrix((bottom - top, right - left), shape) @ translate_matrix(-left, -top)
+    return region, matrix @ np.linalg.inv(to_region)
+
+def apply_affine_batch(batch, matrices, out_shape, out=None):
+    """
+    Function to resample each image of a batch with its own affine matrix (see apply_affine).
+    If 'out' is given, the result is written into it (it can't be 'batch' itself).
+    Images with the identity matrix are copied, see 'apply_selected'.
+    """
+    if tuple(out_shape) == batch.shape[1:3]:
+        selected = np.flatnonzero((matrices != np.eye(3)).any(axis=(1, 2)))
+    else:
+        selected = np.arange(len(batch))
+    def resample(i, dst):
+        apply_affine(batch[i], matrices[i], out_shape, out=dst)
+    if out is None:
+        out = np.empty((len(batch),) + tuple(out_shape) + batch.shape[3:], dtype=batch.dtype)
+    return apply_selected(batch, selected, resample, out)
+
+def apply_lut(img, lut, out=None):
+    """
+    Function to map every value of an image through a lookup table of 256 uint8 values.
+    If 'out' is given, the result is written into it (it can be 'img' itself).
+    """
+    if img.dtype == np.uint8:
+        return cv2.LUT(img, lut, dst=out)
+    return np.take(lut, img.clip(0, 255).astype(np.uint8), out=out)
+
+def apply_luts(batch, luts, out=None):
+    """
+    Function to map every image of a batch through its own lookup table. 'luts' has shape (N, 256).
+    If 'out' is given, the result is written into it (it can be 'batch' itself).
+    Images with the identity table are copied, see 'set_selected'.
+    """
+    if batch.dtype != np.uint8:
+        batch = batch.clip(0, 255).astype(np.uint8)
+    selected = np.flatnonzero((luts != np.arange(256)).any(axis=1))
+    # one gather over the selected images from their tables laid end to end: value v of the k-th selected
+    # image is at 256 * k + v
+    index = batch[selected].astype(np.uint16 if len(selected) <= 256 else np.intp)
+    index += (np.arange(len(selected)) * 256).astype(index.dtype).reshape((-1,) + (1,) * (batch.ndim - 1))
+    return set_selected(batch, selected, np.take(luts[selected].ravel(), index), out)
+
+def sample_mask(n, randomize, mask=None):
+    """
+    Function to draw which of n images a random transformation is applied to.
+    If 'mask' is given, the transformation is only applied where 'mask' is True.
+    """
+    fire = np.random.randint(0, 2, n).astype(bool) if randomize else np.ones(n, dtype=bool)
+    return fire if mask is None else fire & mask
+
+def copy_unselected(batch, selected, out):
+    """ Function to copy the images of a batch that are not at indices 'selected' into 'out', in one assignment"""
+    if out is not batch:
+        unselected = np.ones(len(batch), dtype=bool)
+        unselected[selected] = False
+        if unselected.any():
+            out[unselected] = batch[unselected]
+
+def set_selected(batch, selected, values, out=None):
+    """
+    Function to write 'values', the transformed images of a batch at indices 'selected', into 'out' with
+    one fancy index assignment. The other images are copied unchanged, unless 'out' is 'batch' itself.
+    If no image is selected and there is no 'out', 'batch' is returned as is.
+    """
+    if out is None:
+        if len(selected) == 0:
+            return batch
+        out = np.empty_like(batch)
+    copy_unselected(batch, selected, out)
+    out[selected] = values
+    return out
+
+def apply_selected(batch, selected, apply, out=None):
+    """
+    Function to apply a per-image transformation to the images of a batch at indices 'selected', with
+    apply(i, dst) writing the result of image i into dst, for transformations whose parameters change
+    the shape of their work (kernel sizes, affine matrices). The other images are copied as in
+    'set_selected'.
+    """
+    if out is None:
+        if len(selected) == 0:
+            return batch
+        out = np.empty((len(batch),) + batch.shape[1:], dtype=batch.dtype)
+    copy_unselected(batch, selected, out)
+    for i in selected:
+        apply(i, out[i])
+    return out
+
+def sample_fire(rng, n, randomize):
+    """ Function to draw which of n images a random transformation is applied to, using 'rng'"""
+    return rng.integers(0, 2, n).astype(bool) if randomize else np.ones(n, dtype=bool)
+
+def identity_matrices(n):
+    return np.tile(np.eye(3), (n, 1, 1))
+
+def identity_luts(n):
+    return np.tile(np.arange(256, dtype=np.uint8), (n, 1))
+
+def translate_matrix(dx, dy):
+    return np.array([[1., 0., dx], [0., 1., dy], [0., 0., 1.]])
+
+def resize_matrix(in_shape, out_shape):
+    """ Affine matrix of cv2.resize from in_shape to out_shape, both of form (height, width)"""
+    sy, sx = out_shape[0] / in_shape[0], out_shape[1] / in_shape[1]
+    return np.array([[sx, 0., 0.5 * sx - 0.5], [0., sy, 0.5 * sy - 0.5], [0., 0., 1.]])
+
 class Horizontal_flip(object):
     """ 
     This class provides callable instances that randomly flip an image horizontally
@@ -17,20 +183,98 @@ class Horizontal_flip(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: image of type numpy.ndarray
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
+    An optional preallocated array 'out' can be passed as second argument. If the image is transformed,
+    the result is written into 'out' and returned, else the image itself is returned unchanged.
+    'get_output_spec' gives the shape and dtype 'out' needs. If 'in_place' is set, 'out' can be the image
+    itself. Every transformation in this file follows this protocol, see 'Transformer'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     horiontal_flip_object = Horizontal_flip(randomize=True)
     flipped_image = horiontal_flip_object(image)
     """
+    scale_invariant = True
+    channel_invariant = True
+    in_place = True
+    
     def __init__(self, randomize=True):
         self.randomize = randomize
 
-    def __call__(self, img):
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if do_op:
-            return cv2.flip(img, 1)
+            return cv2.flip(img, 1, dst=out)
         else:
             return img
+    
+    def get_output_spec(self, shape, dtype):
+        """ Returns the (shape, dtype) of the output for an image of the given shape (H, W, C) and dtype"""
+        return tuple(shape), np.dtype(dtype)
+    
+    def get_affine(self, shape):
+        """
+        Samples the transformation for an image of shape (height, width) and returns
+        (matrix, output shape). The matrix is None if the image is not flipped.
+        """
+        do_op = np.random.randint(0,2,1) if self.randomize else 1
+        if do_op:
+            return np.array([[-1., 0., shape[1] - 1], [0., 1., 0.], [0., 0., 1.]]), shape
+        return None, shape
+    
+    def get_affines(self, shape, n, mask=None):
+        """
+        Samples the transformation for a batch of n images of shape (height, width) and returns
+        (matrices of shape (n, 3, 3), output shape). Images that are not flipped get the identity.
+        If 'mask' is given, only images where 'mask' is True can be flipped.
+        """
+        matrices = identity_matrices(n)
+        fire = sample_mask(n, self.randomize, mask)
+        matrices[fire, 0, 0], matrices[fire, 0, 2] = -1, shape[1] - 1
+        return matrices, shape
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """
+        Applies the transformation independently to each image of a batch of shape (N, H, W, C).
+        If 'mask' is given, only images where 'mask' is True can be transformed.
+        If 'out' is given, the result is written into it, see 'set_selected'.
+        """
+        selected = np.flatnonzero(sample_mask(len(batch), self.randomize, mask))
+        values = batch[selected]
+        if len(selected) and values.ndim == 4 and values.shape[3] <= 4:
+            # the selected images stacked as one tall image: cv2.flip reverses all their rows in one call,
+            # several times faster than a numpy copy with a negative stride along the width
+            flat = values.reshape((-1,) + values.shape[2:])
+            cv2.flip(flat, 1, dst=flat)
+        else:
+            values = values[:, :, ::-1]
+        return set_selected(batch, selected, values, out)
+    
+    plan_fields = []
+    
+    def sample_params(self, rng, n):
+        """
+        Samples the transformation for n images using the numpy.random.Generator 'rng'.
+        Returns a dict of arrays of length n, with 'fire' telling which images are transformed and
+        one entry for each of 'plan_fields'. See 'Transformer.make_plan'.
+        """
+        return {'fire': sample_fire(rng, n, self.randomize)}
+    
+    def affine_from_params(self, shape, params):
+        """ Same as get_affine, with the parameters taken from a sample of 'sample_params'"""
+        if params['fire']:
+            return np.array([[-1., 0., shape[1] - 1], [0., 1., 0.], [0., 0., 1.]]), shape
+        return None, shape
+    
+    def apply_params(self, img, params, out=None):
+        """
+        Applies the transformation with the parameters of a sample of 'sample_params'.
+        See the class description for 'out'.
+        """
+        return cv2.flip(img, 1, dst=out) if params['fire'] else img
 
 class Vertical_flip(object):
     """ 
@@ -48,21 +292,68 @@ class Vertical_flip(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: image of type numpy.ndarray
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     vertical_flip_object = Vertical_flip(randomize=True)
     flipped_image = vertical_flip_object(image)
     """
     
+    scale_invariant = True
+    channel_invariant = True
+    in_place = True
+    
     def __init__(self, randomize=True):
         self.randomize = randomize
 
-    def __call__(self, img):
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if do_op:
-            return cv2.flip(img, 0)
+            return cv2.flip(img, 0, dst=out)
         else:
             return img
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec"""
+        return tuple(shape), np.dtype(dtype)
+    
+    def get_affine(self, shape):
+        """ See Horizontal_flip.get_affine"""
+        do_op = np.random.randint(0,2,1) if self.randomize else 1
+        if do_op:
+            return np.array([[1., 0., 0.], [0., -1., shape[0] - 1], [0., 0., 1.]]), shape
+        return None, shape
+    
+    def get_affines(self, shape, n, mask=None):
+        """ See Horizontal_flip.get_affines"""
+        matrices = identity_matrices(n)
+        fire = sample_mask(n, self.randomize, mask)
+        matrices[fire, 1, 1], matrices[fire, 1, 2] = -1, shape[0] - 1
+        return matrices, shape
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """ See Horizontal_flip.apply_batch"""
+        selected = np.flatnonzero(sample_mask(len(batch), self.randomize, mask))
+        return set_selected(batch, selected, batch[selected, ::-1], out)
+    
+    plan_fields = []
+    
+    def sample_params(self, rng, n):
+        """ See Horizontal_flip.sample_params"""
+        return {'fire': sample_fire(rng, n, self.randomize)}
+    
+    def affine_from_params(self, shape, params):
+        """ See Horizontal_flip.affine_from_params"""
+        if params['fire']:
+            return np.array([[1., 0., 0.], [0., -1., shape[0] - 1], [0., 0., 1.]]), shape
+        return None, shape
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        return cv2.flip(img, 0, dst=out) if params['fire'] else img
 
 class Color_jitter(object):
     """ 
@@ -87,23 +378,106 @@ class Color_jitter(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: jittered image of type numpy.ndarray
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     color_jitter_object = Color_jitter(amount=0.05, randomize=True)
     modifier_image = color_jitter_object(image)
     """
+    scale_invariant = False
+    channel_invariant = False
+    pixel_cost = 37
+    pointwise = True
+    in_place = True
+    
     def __init__(self, amount=0.1, randomize=True):
         self.randomize = randomize
         self.amount = amount
+        self._local = threading.local()
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
 
-    def __call__(self, img):
+    def is_identity(self):
+        """ See Gaussian_blur.is_identity"""
+        return int(255*self.amount) == 0
+    
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if do_op:
-            jitter = np.random.randint(-255*self.amount, 255*self.amount, img.shape).clip(0, 255).astype(np.uint8)
-            return cv2.add(img, jitter)
+            return cv2.add(img, self.get_jitter(img.shape), dst=out)
         else:
             return img
-            
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec"""
+        return tuple(shape), np.dtype(dtype)
+    
+    def get_buffer(self, shape, dtype=np.uint8, offset=0):
+        """
+        Returns an array of the given shape and dtype starting at byte 'offset' of a buffer of the calling
+        thread, which grows to the largest size asked for and is then reused.
+        """
+        nbytes = offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None or buf.nbytes < nbytes:
+            buf = self._local.buffer = np.empty(nbytes, dtype=np.uint8)
+        return buf[offset:nbytes].view(dtype).reshape(shape)
+    
+    def get_jitter(self, shape, rng=None, seed=None):
+        """
+        Draws the uint8 shifts for an image (or batch) of the given shape into a reused per-thread buffer, so
+        they are only valid until the next call from the same thread.
+        The shifts are drawn by cv2.randu from 'seed', which is drawn from 'rng' (a numpy.random.Generator)
+        or else from the global numpy state if not given.
+        """
+        if seed is None:
+            seed = np.random.randint(2**31) if rng is None else rng.integers(2**31)
+        cv2.setRNGSeed(int(seed) % 2**31)
+        low, high = int(-255*self.amount), int(255*self.amount)
+        jitter = self.get_buffer(shape)
+        if high - low <= 256:
+            # draw the shifts as uint8 in [0, high - low) and map them to max(shift + low, 0) in place
+            cv2.randu(jitter.reshape(-1, 1), 0, high - low)
+            cv2.LUT(jitter, np.maximum(np.arange(256) + low, 0).clip(0, 255).astype(np.uint8), dst=jitter)
+            return jitter
+        shifts = self.get_buffer(shape, np.int16, jitter.nbytes)
+        cv2.randu(shifts.reshape(-1, 1), low, high)
+        np.copyto(jitter, shifts.clip(0, 255, out=shifts), casting='unsafe')
+        return jitter
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """ See Horizontal_flip.apply_batch"""
+        selected = np.flatnonzero(sample_mask(len(batch), self.randomize, mask))
+        values = batch[selected]
+        if len(selected):
+            # one saturating add over the selected images, stacked as one tall image
+            flat = values.reshape((-1,) + values.shape[2:])
+            cv2.add(flat, self.get_jitter(flat.shape), dst=flat)
+        return set_selected(batch, selected, values, out)
+    
+    plan_fields = [('seed', np.uint64)]
+    
+    def sample_params(self, rng, n):
+        """ See Horizontal_flip.sample_params. The shifts are drawn from 'seed', see 'get_jitter'."""
+        return {'fire': sample_fire(rng, n, self.randomize),
+                'seed': rng.integers(0, 2**63, n, dtype=np.uint64)}
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        if params['fire']:
+            return cv2.add(img, self.get_jitter(img.shape, seed=params['seed']), dst=out)
+        return img
+
 class Gaussian_blur(object):
     """ 
     This class provides callable instances that take an image of type numpy.ndarray
@@ -127,23 +501,71 @@ class Gaussian_blur(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: blurred image of type numpy.ndarray
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     blur_object = Gaussian_blur(amount=3, randomize=True)
     modifier_image = blur_object(image)
     """
+    scale_invariant = False
+    channel_invariant = True
+    in_place = True
+    linear_filter = True
+    
     def __init__(self, amount=1, randomize=True):
         self.randomize = randomize
         self.amount = amount
+    
+    @property
+    def pixel_cost(self):
+        # the kernel size averages 'amount', and the cost grows about linearly with it
+        return 0.75 * self.amount
+    
+    def is_identity(self):
+        """ Returns True if the transformation never changes an image (a kernel of size 1)"""
+        return self.amount <= 1
 
-    def __call__(self, img):
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if do_op:
-            kernel = np.random.randint(0, self.amount, 1) * 2 + 1
-            return cv2.GaussianBlur(img, (kernel, kernel), 0)
+            kernel = np.random.randint(0, self.amount, 1)[0] * 2 + 1
+            return cv2.GaussianBlur(img, (kernel, kernel), 0, dst=out)
         else:
             return img
-            
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec"""
+        return tuple(shape), np.dtype(dtype)
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """
+        See Horizontal_flip.apply_batch. Kernel sizes are drawn for the whole batch at once;
+        cv2 has no batched blur, so each selected image is blurred into the output in turn.
+        Images drawing a kernel of size 1 are left unchanged.
+        """
+        fire = sample_mask(len(batch), self.randomize, mask)
+        kernels = np.random.randint(0, self.amount, len(batch)) * 2 + 1
+        def blur(i, dst):
+            cv2.GaussianBlur(batch[i], (int(kernels[i]), int(kernels[i])), 0, dst=dst)
+        return apply_selected(batch, np.flatnonzero(fire & (kernels > 1)), blur, out)
+    
+    plan_fields = [('kernel', np.uint8)]
+    
+    def sample_params(self, rng, n):
+        """ See Horizontal_flip.sample_params"""
+        return {'fire': sample_fire(rng, n, self.randomize),
+                'kernel': rng.integers(0, self.amount, n) * 2 + 1}
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        if params['fire']:
+            kernel = int(params['kernel'])
+            return cv2.GaussianBlur(img, (kernel, kernel), 0, dst=out)
+        return img
+
 class Rotate_rand(object):
     """ 
     This class provides callable instances that take an image of type numpy.ndarray
@@ -165,27 +587,87 @@ class Rotate_rand(object):
     -------
     A callable instance of the class that acts as a function.
     The functions takes as argument an image of type numpy.ndarray
-    Returns: rotated image of type numpy.ndarray. The ia
+    Returns: rotated image of type numpy.ndarray, of the same shape and dtype as the input.
+             Regions rotated in from outside the image are filled with zeros.
+    
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
     
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     rotate_object = Rotate_rand(amount=30, randomize=True)
     modifier_image = rotate_object(image)
     """
+    scale_invariant = True
+    channel_invariant = True
+    in_place = False
+    
     def __init__(self, amount=30, randomize=True):
-        import skimage.transform as tfms
-        self.rotate = tfms.rotate
         self.randomize = randomize
         self.amount = amount
 
-    def __call__(self, img):
-        do_op = np.random.randint(0,2,1) if self.randomize else 1
-        if do_op:
-            degrees = np.random.randint(-self.amount, self.amount, 1)
-            return self.rotate(img, degrees)
+    def is_identity(self):
+        """ See Gaussian_blur.is_identity"""
+        return self.amount == 0
+    
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
+        matrix, shape = self.get_affine(img.shape[:2])
+        if matrix is not None:
+            return cv2.warpAffine(img, matrix[:2], (shape[1], shape[0]), dst=out, flags=cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_CONSTANT, borderValue=0)
         else:
             return img
-            
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec"""
+        return tuple(shape), np.dtype(dtype)
+    
+    def get_affine(self, shape):
+        """ See Horizontal_flip.get_affine. Rotation is counter-clockwise about the image center."""
+        do_op = np.random.randint(0,2,1) if self.randomize else 1
+        if do_op:
+            degrees = np.random.randint(-self.amount, self.amount, 1)[0]
+            center = ((shape[1] - 1) / 2, (shape[0] - 1) / 2)
+            return np.vstack([cv2.getRotationMatrix2D(center, float(degrees), 1.0), [0., 0., 1.]]), shape
+        return None, shape
+    
+    def get_affines(self, shape, n, mask=None):
+        """ See Horizontal_flip.get_affines"""
+        fire = sample_mask(n, self.randomize, mask)
+        radians = np.deg2rad(np.random.randint(-self.amount, self.amount, n)) * fire
+        alpha, beta = np.cos(radians), np.sin(radians)
+        cx, cy = (shape[1] - 1) / 2, (shape[0] - 1) / 2
+        matrices = identity_matrices(n)
+        # same matrix as cv2.getRotationMatrix2D
+        matrices[:, 0, 0], matrices[:, 0, 1], matrices[:, 0, 2] = alpha, beta, (1 - alpha) * cx - beta * cy
+        matrices[:, 1, 0], matrices[:, 1, 1], matrices[:, 1, 2] = -beta, alpha, beta * cx + (1 - alpha) * cy
+        return matrices, shape
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """ See Horizontal_flip.apply_batch. Each image is resampled with cv2.warpAffine in turn."""
+        matrices, shape = self.get_affines(batch.shape[1:3], len(batch), mask)
+        return apply_affine_batch(batch, matrices, shape, out)
+    
+    plan_fields = [('degrees', np.int16)]
+    
+    def sample_params(self, rng, n):
+        """ See Horizontal_flip.sample_params"""
+        return {'fire': sample_fire(rng, n, self.randomize),
+                'degrees': rng.integers(-self.amount, self.amount, n)}
+    
+    def affine_from_params(self, shape, params):
+        """ See Horizontal_flip.affine_from_params"""
+        if params['fire']:
+            center = ((shape[1] - 1) / 2, (shape[0] - 1) / 2)
+            return np.vstack([cv2.getRotationMatrix2D(center, float(params['degrees']), 1.0), [0., 0., 1.]]), shape
+        return None, shape
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        matrix, shape = self.affine_from_params(img.shape[:2], params)
+        return img if matrix is None else apply_affine(img, matrix, shape, out)
+
 class Crop_and_resize(object):
     """ 
     This class provides callable instances that take an image of type numpy.ndarray.
@@ -231,11 +713,17 @@ class Crop_and_resize(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: cropped and resized image of type numpy.ndarray
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     crop_object = Crop_and_resize(amount=0.1, randomize=True, do_crop=True)
     modifier_image = crop_object(image)
     """
+    scale_invariant = True
+    channel_invariant = True
+    in_place = False
+    
     def __init__(self, amount=0.1, randomize=True, sz=-1, do_crop=None, crop_box=-1):
         self.randomize = randomize
         self.amount = amount
@@ -244,9 +732,14 @@ class Crop_and_resize(object):
         self.do_crop = do_crop
         self.box = crop_box
         
+    def is_identity(self):
+        """ See Gaussian_blur.is_identity"""
+        return self.do_crop == False and self.resize_dims == -1
+    
     def get_crop_box(self, img):
+        """ 'img' can be an image or its shape"""
         if self.box == -1:
-            h, b, _ = img.shape
+            h, b = (img.shape if hasattr(img, 'shape') else img)[:2]
             randx = np.random.randint(0, b*self.amount, 1)[0]
             rand_breadth = np.random.randint(randx + b*(1-self.amount), b, 1)[0]
             randy = np.random.randint(0, h*self.amount, 1)[0]
@@ -256,29 +749,159 @@ class Crop_and_resize(object):
             return self.box
         
     def crop(self, img):
+        box = self.sample_box(img.shape)
+        if box is not None:
+            return img[box[0]:box[1], box[2]:box[3]]
+        else:
+            return img
+    
+    def sample_box(self, shape):
+        """ Returns the crop box for an image of the given shape, or None if it is not cropped"""
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if self.do_crop != False:
             if self.do_crop or do_op:    #if cropping is compulsory
-                box = self.get_crop_box(img)
-                return img[box[0]:box[1], box[2]:box[3], :]
-            else:
-                return img
+                return self.get_crop_box(shape)
+        return None
+    
+    def get_affine(self, shape):
+        """ See Horizontal_flip.get_affine. The matrix is never None."""
+        return self.affine_from_box(shape, self.sample_box(shape))
+    
+    def affine_from_box(self, shape, box):
+        """ Returns (matrix, output shape) to crop an image of the given shape to 'box' (or None) and resize it"""
+        if box is None:
+            matrix, crop_shape = np.eye(3), tuple(shape)
         else:
-            return img
+            matrix, crop_shape = translate_matrix(-box[2], -box[0]), (box[1] - box[0], box[3] - box[2])
+        out_shape = tuple(shape) if self.resize_dims == -1 else (self.resize_dims[1], self.resize_dims[0])
+        return resize_matrix(crop_shape, out_shape) @ matrix, out_shape
+    
+    def scaled(self, factor):
+        """
+        Returns a copy of this transformation for images scaled by 'factor', with a fixed 'crop_box'
+        scaled accordingly. Random crop boxes are relative to the image size and need no change.
+        The scaled box is kept exact: when it falls between pixels, the image is cropped and resized
+        with one sub-pixel affine resampling instead of being rounded to whole pixels.
+        """
+        scaled = copy.copy(self)
+        if self.box != -1:
+            box = tuple(v * factor for v in self.box)
+            scaled.box = tuple(int(v) for v in box) if all(float(v).is_integer() for v in box) else box
+        return scaled
+    
+    def sample_boxes(self, shape, n, mask=None):
+        """
+        Vectorized version of sample_box for n images of the given shape.
+        Returns an array of shape (n, 4) of boxes (top, bottom, left, right). Images that are
+        not cropped get the full image as their box.
+        """
+        h, b = shape[:2]
+        # boxes scaled by 'scaled' may fall between pixels
+        boxes = np.tile(np.array([0, h, 0, b], dtype=np.float64), (n, 1))
+        fire = np.random.randint(0, 2, n).astype(bool) if self.randomize else np.ones(n, dtype=bool)
+        if self.do_crop == False:
+            return boxes
+        elif self.do_crop:
+            fire[:] = True
+        if mask is not None:
+            fire &= mask
+        if self.box != -1:
+            boxes[fire] = self.box
+        else:
+            randx = np.random.randint(0, b*self.amount, n)
+            rand_breadth = np.random.randint(randx + b*(1-self.amount), b)
+            randy = np.random.randint(0, h*self.amount, n)
+            rand_height = np.random.randint(randy + h*(1-self.amount), h)
+            boxes[fire] = np.stack([randy, rand_height, randx, rand_breadth], axis=1)[fire]
+        return boxes
+    
+    def get_affines(self, shape, n, mask=None):
+        """
+        See Horizontal_flip.get_affines. If this transformation changes the image size, images where
+        'mask' is False are not cropped but still resized, so that all images have the same size.
+        """
+        out_shape = tuple(shape) if self.resize_dims == -1 else (self.resize_dims[1], self.resize_dims[0])
+        boxes = self.sample_boxes(shape, n, mask)
+        heights, widths = boxes[:, 1] - boxes[:, 0], boxes[:, 3] - boxes[:, 2]
+        sy, sx = out_shape[0] / heights, out_shape[1] / widths
+        matrices = identity_matrices(n)
+        # resize_matrix(crop shape, out_shape) @ translate_matrix(-left, -top) for every image
+        matrices[:, 0, 0], matrices[:, 0, 2] = sx, 0.5 * sx - 0.5 - sx * boxes[:, 2]
+        matrices[:, 1, 1], matrices[:, 1, 2] = sy, 0.5 * sy - 0.5 - sy * boxes[:, 0]
+        if mask is not None and out_shape == tuple(shape):
+            matrices[~mask] = np.eye(3)
+        return matrices, out_shape
     
-    def resize(self, img, img_dims):
+    def apply_batch(self, batch, mask=None, out=None):
+        """ See Horizontal_flip.apply_batch. Each image is cropped and resized with cv2 in turn."""
+        matrices, shape = self.get_affines(batch.shape[1:3], len(batch), mask)
+        return apply_affine_batch(batch, matrices, shape, out)
+    
+    def resize(self, img, img_dims, out=None):
         ## self.resize = (width, height)
         if self.resize_dims == -1:
-            return cv2.resize(img, (img_dims[1], img_dims[0]), interpolation=cv2.INTER_LINEAR)
+            return cv2.resize(img, (img_dims[1], img_dims[0]), dst=out, interpolation=cv2.INTER_LINEAR)
         else:
             resz_product = self.resize_dims[0] * self.resize_dims[1]
             sz_product = img.shape[0] * img.shape[1]
             interp_method = cv2.INTER_LINEAR if resz_product > sz_product else cv2.INTER_AREA
-            return cv2.resize(img, (self.resize_dims[0], self.resize_dims[1]), interpolation=interp_method)
+            return cv2.resize(img, (self.resize_dims[0], self.resize_dims[1]), dst=out, interpolation=interp_method)
+    
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
+        box = self.sample_box(img.shape)
+        if box is not None and not all(float(v).is_integer() for v in box):
+            return apply_affine(img, *self.affine_from_box(img.shape[:2], box), out=out)
+        cropped = img if box is None else img[int(box[0]):int(box[1]), int(box[2]):int(box[3])]
+        return self.resize(cropped, img.shape, out)
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec"""
+        if self.resize_dims == -1:
+            return tuple(shape), np.dtype(dtype)
+        return (self.resize_dims[1], self.resize_dims[0]) + tuple(shape[2:]), np.dtype(dtype)
     
-    def __call__(self, img):
-        return self.resize(self.crop(img), img.shape)
-  
+    plan_fields = [('crop', bool), ('box', np.float32, (4,))]
+    
+    def sample_params(self, rng, n):
+        """
+        See Horizontal_flip.sample_params. Since the image size is not known in advance, random boxes
+        are stored as fractions (top, bottom, left, right) of the image height and width.
+        'fire' is always True: the image is resized even when it is not cropped.
+        """
+        crop = np.zeros(n, dtype=bool)
+        if self.do_crop != False:
+            crop = np.ones(n, dtype=bool) if self.do_crop else sample_fire(rng, n, self.randomize)
+        left = rng.random(n) * self.amount
+        right = left + (1 - self.amount) + rng.random(n) * (self.amount - left)
+        top = rng.random(n) * self.amount
+        bottom = top + (1 - self.amount) + rng.random(n) * (self.amount - top)
+        return {'fire': np.ones(n, dtype=bool), 'crop': crop,
+                'box': np.stack([top, bottom, left, right], axis=1)}
+    
+    def box_from_params(self, shape, params):
+        """ Returns the crop box for an image of the given shape, or None if it is not cropped"""
+        if not params['crop']:
+            return None
+        if self.box != -1:
+            return self.box
+        h, b = shape[:2]
+        top, bottom, left, right = params['box']
+        top, left = int(top * h), int(left * b)
+        return (top, max(int(bottom * h), top + 1), left, max(int(right * b), left + 1))
+    
+    def affine_from_params(self, shape, params):
+        """ See Horizontal_flip.affine_from_params"""
+        if not params['fire']:
+            return None, shape
+        return self.affine_from_box(shape, self.box_from_params(shape, params))
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        matrix, shape = self.affine_from_params(img.shape[:2], params)
+        return img if matrix is None else apply_affine(img, matrix, shape, out)
+
 class Brightness(object):
     """ 
     This class provides callable instances that take an image of type numpy.ndarray
@@ -303,22 +926,96 @@ class Brightness(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: image of type numpy.ndarray with modified brightness
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     brightness_object = Brightness(amount=0.3, randomize=True)
     modifier_image = brightness_object(image)
     """
+    scale_invariant = True
+    channel_invariant = True
+    pixel_cost = 2.7
+    pointwise = True
+    in_place = True
+    
     def __init__(self, amount=0.05, randomize=True):
         self.randomize = randomize
         self.amount = amount
 
-    def __call__(self, img):
+    def is_identity(self):
+        """ See Gaussian_blur.is_identity"""
+        return int(255*self.amount) == 0
+    
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
+        lut = self.get_lut()
+        if lut is None:
+            return img
+        else:
+            return apply_lut(img, lut, out)
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec. Images of other dtypes are clipped and converted to uint8."""
+        return tuple(shape), np.dtype(np.uint8)
+    
+    def get_lut(self):
+        """
+        Samples the transformation and returns it as a lookup table of 256 uint8 values,
+        or None if the brightness is not modified.
+        """
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if do_op:
-            return (img + np.random.randint(-255*self.amount, 255*self.amount, 1)[0]).clip(0, 255)
-        else:
-            return img
-        
+            return (np.arange(256) + np.random.randint(-255*self.amount, 255*self.amount, 1)[0]).clip(0, 255).astype(np.uint8)
+        return None
+    
+    def get_luts(self, n, mask=None):
+        """
+        Samples the transformation for a batch of n images and returns lookup tables of shape (n, 256).
+        Images that are not modified get the identity. If 'mask' is given, only images where 'mask'
+        is True can be modified.
+        """
+        fire = sample_mask(n, self.randomize, mask)
+        shifts = np.random.randint(-255*self.amount, 255*self.amount, n) * fire
+        return (np.arange(256) + shifts[:, None]).clip(0, 255).astype(np.uint8)
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """ See Horizontal_flip.apply_batch. The shifts are broadcast over the selected images."""
+        if batch.dtype != np.uint8:
+            batch = batch.clip(0, 255).astype(np.uint8)
+        fire = sample_mask(len(batch), self.randomize, mask)
+        shifts = np.random.randint(-255*self.amount, 255*self.amount, len(batch)) * fire
+        selected = np.flatnonzero(shifts)
+        values = batch[selected]
+        # saturating add in uint8: min(v, 255 - up) + up, then max(v, down) - down
+        shape = (-1,) + (1,) * (batch.ndim - 1)
+        up = np.maximum(shifts[selected], 0).clip(0, 255).astype(np.uint8).reshape(shape)
+        down = np.maximum(-shifts[selected], 0).clip(0, 255).astype(np.uint8).reshape(shape)
+        np.minimum(values, 255 - up, out=values)
+        values += up
+        np.maximum(values, down, out=values)
+        values -= down
+        return set_selected(batch, selected, values, out)
+    
+    plan_fields = [('shift', np.int16)]
+    
+    def sample_params(self, rng, n):
+        """ See Horizontal_flip.sample_params"""
+        return {'fire': sample_fire(rng, n, self.randomize),
+                'shift': rng.integers(int(-255*self.amount), int(255*self.amount), n)}
+    
+    def lut_from_params(self, params):
+        """ Same as get_lut, with the parameters taken from a sample of 'sample_params'"""
+        if params['fire']:
+            return (np.arange(256) + int(params['shift'])).clip(0, 255).astype(np.uint8)
+        return None
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        lut = self.lut_from_params(params)
+        return img if lut is None else apply_lut(img, lut, out)
+
 class Contrast(object):
     """ 
     This class provides callable instances that take an image of type numpy.ndarray
@@ -343,18 +1040,71 @@ class Contrast(object):
     The functions takes as argument an image of type numpy.ndarray
     Returns: image of type numpy.ndarray with modified contrast
     
+    A batch of images of shape (N, H, W, C) can also be passed, see 'apply_batch'.
+    
     Example Usage : 
     image = cv2.imread(PATH_TO_IMAGE)
     contrast_object = Contrast(amount=0.3, randomize=True)
     modifier_image = contrast_object(image)
     """
+    scale_invariant = True
+    channel_invariant = True
+    pixel_cost = 2.7
+    pointwise = True
+    in_place = True
+    
     def __init__(self, amount=0.05, randomize=True):
         self.randomize = randomize
         self.amount = amount
 
-    def __call__(self, img):
+    def is_identity(self):
+        """ See Gaussian_blur.is_identity"""
+        return self.amount == 0
+    
+    def __call__(self, img, out=None):
+        if img.ndim == 4:
+            return self.apply_batch(img)
+        lut = self.get_lut()
+        if lut is None:
+            return img
+        else:
+            return apply_lut(img, lut, out)
+    
+    def get_output_spec(self, shape, dtype):
+        """ See Horizontal_flip.get_output_spec. Images of other dtypes are clipped and converted to uint8."""
+        return tuple(shape), np.dtype(np.uint8)
+    
+    def get_lut(self):
+        """ See Brightness.get_lut"""
         do_op = np.random.randint(0,2,1) if self.randomize else 1
         if do_op:
-            return (img * (1 + np.random.uniform(-self.amount, self.amount, 1)[0])).astype(int).clip(0, 255)
-        else:
-            return img  
\ No newline at end of file
+            return (np.arange(256) * (1 + np.random.uniform(-self.amount, self.amount, 1)[0])).astype(int).clip(0, 255).astype(np.uint8)
+        return None
+    
+    def get_luts(self, n, mask=None):
+        """ See Brightness.get_luts"""
+        fire = sample_mask(n, self.randomize, mask)
+        factors = 1 + np.random.uniform(-self.amount, self.amount, n) * fire
+        return (np.arange(256) * factors[:, None]).astype(int).clip(0, 255).astype(np.uint8)
+    
+    def apply_batch(self, batch, mask=None, out=None):
+        """ See Horizontal_flip.apply_batch"""
+        return apply_luts(batch, self.get_luts(len(batch), mask), out)
+    
+    plan_fields = [('factor', np.float32)]
+    
+    def sample_params(self, rng, n):
+        """ See Horizontal_flip.sample_params"""
+        return {'fire': sample_fire(rng, n, self.randomize),
+                'factor': 1 + rng.uniform(-self.amount, self.amount, n)}
+    
+    def lut_from_params(self, params):
+        """ See Brightness.lut_from_params"""
+        if params['fire']:
+            return (np.arange(256) * float(params['factor'])).astype(int).clip(0, 255).astype(np.uint8)
+        return None
+    
+    def apply_params(self, img, params, out=None):
+        """ See Horizontal_flip.apply_params"""
+        lut = self.lut_from_params(params)
+        return img if lut is None else apply_lut(img, lut, out)
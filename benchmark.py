@@ -0,0 +1,225 @@
+"""
+Benchmarks for the transformations in aug_transforms.py, Transformer pipelines and reading images
+end to end through ImageReader / DataLoader.
+
+Synthetic image directories of several resolutions and formats are generated in a temporary directory.
+For every benchmark, the median and mean latency, the throughput in images per second and the peak memory
+allocated while transforming one image (measured with tracemalloc, which numpy reports to) are recorded.
+'peak_images' gives the peak memory in units of the output image size, i.e. roughly how many full-size
+temporary arrays a call allocates.
+
+Example Usage:
+python benchmark.py --output results.json
+python benchmark.py --baseline results.json --threshold 0.1
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from ImageReader import *
+from DataLoader import *
+
+RESOLUTIONS = {'small': (256, 256), 'medium': (768, 1024), 'large': (3000, 4000)}
+FORMATS = ('.jpg', '.png')
+
+def make_image(shape, rng):
+    """ Function to make a smooth random RGB image of shape (height, width), which compresses like a photo"""
+    h, w = shape
+    small = rng.integers(0, 256, (max(h // 16, 2), max(w // 16, 2), 3), dtype=np.uint8)
+    img = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+    noise = rng.integers(0, 16, img.shape, dtype=np.uint8)
+    return cv2.add(img, noise)
+
+def make_dataset(root, n, shape, suffix, seed=0):
+    """ Function to write n synthetic images of the given shape and extension to root"""
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(n):
+        cv2.imwrite(os.path.join(root, 'img%05d%s' % (i, suffix)), make_image(shape, rng))
+    return root
+
+def time_call(fn, repeat, warmup=1):
+    """
+    Function to call fn repeatedly. Returns the list of durations in seconds.
+    The global numpy random state is reset first, so random transformations fire the same way in
+    every run and in every benchmark.
+    """
+    np.random.seed(0)
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def peak_memory(fn):
+    """ Function to measure the peak memory (in bytes) allocated by one call of fn and its result's size"""
+    np.random.seed(0)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    nbytes = result.nbytes if isinstance(result, np.ndarray) else 0
+    return peak, nbytes
+
+def record(durations, images_per_call, peak=None, out_nbytes=None):
+    # random transformations make single calls uneven, so throughput uses the mean duration
+    result = {'latency_ms': float(np.median(durations) * 1e3),
+              'mean_latency_ms': float(np.mean(durations) * 1e3),
+              'images_per_s': float(images_per_call / np.mean(durations))}
+    if peak is not None:
+        result['peak_bytes'] = int(peak)
+        result['peak_images'] = float(peak / out_nbytes) if out_nbytes else None
+    return result
+
+def get_transforms():
+    """ One instance of every transformation, applied on every call"""
+    return [Horizontal_flip(randomize=False), Vertical_flip(randomize=False),
+            Brightness(amount=0.1, randomize=False), Contrast(amount=0.1, randomize=False),
+            Color_jitter(amount=0.05, randomize=False), Gaussian_blur(amount=3, randomize=False),
+            Rotate_rand(amount=30, randomize=False),
+            Crop_and_resize(amount=0.1, randomize=False, sz=(224, 224))]
+
+def get_pipelines():
+    return {
+        'geometric': [Horizontal_flip(), Vertical_flip(), Rotate_rand(30), Crop_and_resize(sz=(224, 224))],
+        'photometric': [Brightness(0.1), Contrast(0.1), Color_jitter(0.05)],
+        'full': [Horizontal_flip(), Rotate_rand(15), Crop_and_resize(sz=(224, 224)),
+                 Brightness(0.1), Contrast(0.1), Color_jitter(0.05), Gaussian_blur(2)],
+    }
+
+def bench_transforms(images, repeat):
+    results = {}
+    for res, img in images.items():
+        for tfm in get_transforms():
+            durations = time_call(lambda: tfm(img), repeat)
+            results['transform/%s/%s' % (type(tfm).__name__, res)] = record(durations, 1, *peak_memory(lambda: tfm(img)))
+    return results
+
+def bench_pipelines(images, repeat, batch_size):
+    results = {}
+    for res, img in images.items():
+        for name, tfms in get_pipelines().items():
+            for fuse in (True, False):
+                transformer = Transformer(tfms, fuse=fuse)
+                key = 'pipeline/%s%s/%s' % (name, '' if fuse else '-unfused', res)
+                durations = time_call(lambda: transformer(img), repeat)
+                results[key] = record(durations, 1, *peak_memory(lambda: transformer(img)))
+            batch = np.stack([img] * batch_size)
+            transformer = Transformer(tfms)
+            durations = time_call(lambda: transformer(batch), max(repeat // batch_size, 3))
+            results['pipeline/%s-batch%d/%s' % (name, batch_size, res)] = \
+                record(durations, batch_size, *peak_memory(lambda: transformer(batch)))
+    return results
+
+def bench_readers(roots, repeat, batch_size, num_workers):
+    results = {}
+    tfms = [Horizontal_flip(), Crop_and_resize(sz=(224, 224)), Brightness(0.1)]
+    for key, root in roots.items():
+        reader = ImageReader(root, transforms=tfms)
+        durations = time_call(lambda: reader.read_image_from_idx(np.random.randint(reader.len)), repeat)
+        results['reader/%s/single' % key] = record(durations, 1, *peak_memory(lambda: reader.read_image_from_idx(0)))
+        raw = ImageReader(root, transforms=tfms, reduced_decode=False)
+        durations = time_call(lambda: raw.read_image_from_idx(np.random.randint(raw.len)), repeat)
+        results['reader/%s/single-full-decode' % key] = record(durations, 1)
+        durations = time_call(lambda: reader.read_batch_random(batch_size), max(repeat // batch_size, 3))
+        results['reader/%s/batch%d' % (key, batch_size)] = record(durations, batch_size)
+        formatted = ImageReader(root, transforms=tfms, output=OutputFormat(np.float32, mean=0.5, std=0.25, layout='CHW'))
+        durations = time_call(lambda: formatted.read_batch_random(batch_size), max(repeat // batch_size, 3))
+        results['reader/%s/batch%d-chw-float32' % (key, batch_size)] = record(durations, batch_size)
+        echoed = ImageReader(root, transforms=tfms, echo=2)
+        durations = time_call(lambda: echoed.read_batch_random(batch_size), max(repeat // batch_size, 3))
+        results['reader/%s/batch%d-echo2' % (key, batch_size)] = record(durations, batch_size)
+        for backend in ('thread', 'process'):
+            loader = DataLoader(reader, batch_size=batch_size, num_workers=num_workers, backend=backend)
+            durations = time_call(lambda: sum(len(b) for b in loader), 1, warmup=0)
+            results['reader/%s/%s%d' % (key, backend, num_workers)] = record(durations, reader.len)
+        loader = DataLoader(reader, batch_size=batch_size, num_workers=num_workers, backend='process',
+                            shared_memory=True)
+        durations = time_call(lambda: sum(len(b) for b in loader), 1, warmup=0)
+        results['reader/%s/process-shm%d' % (key, num_workers)] = record(durations, reader.len)
+        loader.close()
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Function to compare results with a baseline. Returns a list of regressions, i.e. benchmarks whose
+    throughput dropped or whose peak memory grew by more than 'threshold' (a fraction).
+    """
+    regressions = []
+    for key, base in baseline['results'].items():
+        new = results['results'].get(key)
+        if new is None:
+            continue
+        if new['images_per_s'] < base['images_per_s'] * (1 - threshold):
+            regressions.append('%s: %.1f -> %.1f images/s' % (key, base['images_per_s'], new['images_per_s']))
+        if base.get('peak_bytes') and new.get('peak_bytes', 0) > base['peak_bytes'] * (1 + threshold):
+            regressions.append('%s: peak memory %d -> %d bytes' % (key, base['peak_bytes'], new['peak_bytes']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS))
+    parser.add_argument('--count', type=int, default=64, help='number of images per synthetic directory')
+    parser.add_argument('--repeat', type=int, default=50, help='number of timed calls per benchmark')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--only', nargs='+', default=['transforms', 'pipelines', 'readers'],
+                        choices=['transforms', 'pipelines', 'readers'])
+    parser.add_argument('--output', help='path to write the results to as JSON')
+    parser.add_argument('--baseline', help='path to JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    images = {res: make_image(RESOLUTIONS[res], rng) for res in args.resolutions}
+    results = {}
+    tmp = tempfile.mkdtemp(prefix='imagereader_bench_')
+    try:
+        if 'transforms' in args.only:
+            results.update(bench_transforms(images, args.repeat))
+        if 'pipelines' in args.only:
+            results.update(bench_pipelines(images, args.repeat, args.batch_size))
+        if 'readers' in args.only:
+            roots = {}
+            for res in args.resolutions:
+                for suffix in args.formats:
+                    key = '%s%s' % (res, suffix)
+                    roots[key] = make_dataset(os.path.join(tmp, key), args.count, RESOLUTIONS[res], suffix)
+            results.update(bench_readers(roots, args.repeat, args.batch_size, args.workers))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    output = {'meta': {'python': sys.version.split()[0], 'numpy': np.__version__, 'opencv': cv2.__version__,
+                       'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'time': time.time()},
+              'results': results}
+    for key, value in sorted(results.items()):
+        peak = '' if 'peak_bytes' not in value else '  peak %8.2f MB' % (value['peak_bytes'] / 2**20)
+        print('%-50s %9.3f ms %10.1f images/s%s' % (key, value['latency_ms'], value['images_per_s'], peak))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(output, json.load(f), args.threshold)
+        for line in regressions:
+            print('REGRESSION', line)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import struct
+
+JPEG_SUFFIXES = ('.jpg', '.jpeg', '.jpe', '.jfif')
+
+# JPEG start-of-frame markers, which hold the image dimensions
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def read_image_size(path):
+    """
+    Function to read the (height, width) of a JPEG or PNG image from its header, without decoding it.
+    Returns None for other formats or if the header can't be parsed.
+    Note that the EXIF orientation of JPEG images is not taken into account.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(24)
+            if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+                width, height = struct.unpack('>II', head[16:24])
+                return height, width
+            if head[:2] != b'\xff\xd8':
+                return None
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                while marker[:1] == b'\xff' and marker[1:2] == b'\xff':
+                    # fill bytes
+                    marker = marker[1:] + f.read(1)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                length = struct.unpack('>H', f.read(2))[0]
+                if marker[1] in _SOF_MARKERS:
+                    height, width = struct.unpack('>xHH', f.read(5))
+                    return height, width
+                f.seek(length - 2, 1)
+    except (OSError, struct.error):
+        return None
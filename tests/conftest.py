@@ -0,0 +1,26 @@
+import os
+import sys
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def write_images(path, n=12, seed=0):
+    """ Writes n smooth random RGB images of different sizes as lossless PNG files and returns their IDs"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(path, exist_ok=True)
+    ids = []
+    for i in range(n):
+        h, w = 40 + 7 * i, 60 + 5 * i
+        small = rng.integers(0, 256, (h // 8, w // 8, 3), dtype=np.uint8)
+        img = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+        cv2.imwrite(os.path.join(path, 'img_%02d.png' % i), img)
+        ids.append('img_%02d' % i)
+    return ids
+
+@pytest.fixture
+def image_dir(tmp_path):
+    path = str(tmp_path / 'images')
+    write_images(path)
+    return path
@@ -0,0 +1,37 @@
+import numpy as np
+from aug_transforms import (Horizontal_flip, Vertical_flip, Color_jitter, Gaussian_blur, Rotate_rand, Brightness,
+                            Contrast, Crop_and_resize)
+from Transformer import Transformer
+
+def make_batch(n=2, h=24, w=32):
+    return np.random.RandomState(0).randint(0, 256, (n, h, w, 3)).astype(np.uint8)
+
+def test_apply_batch_nothing_fires():
+    batch = make_batch()
+    mask = np.zeros(len(batch), dtype=bool)
+    for tfm in [Horizontal_flip(), Vertical_flip(), Color_jitter(), Gaussian_blur(), Rotate_rand(),
+                Brightness(), Contrast()]:
+        result = tfm.apply_batch(batch, mask)
+        np.testing.assert_array_equal(result, batch)
+        out = np.zeros_like(batch)
+        assert tfm.apply_batch(batch, mask, out) is out
+        np.testing.assert_array_equal(out, batch)
+
+def test_transformer_batch_random():
+    # with two images, every op skips the whole batch now and then
+    batch = make_batch()
+    transformer = Transformer([Horizontal_flip(), Color_jitter(), Gaussian_blur(), Brightness(), Contrast()])
+    np.random.seed(0)
+    for _ in range(50):
+        result = transformer(batch)
+        assert result.shape == batch.shape and result.dtype == batch.dtype
+
+def test_transformer_batch_resize_always_applies():
+    # skipping a resize for part of the batch would leave images of different sizes
+    batch = make_batch(3, 40, 50)
+    for fuse in (True, False):
+        transformer = Transformer([Horizontal_flip(), Crop_and_resize(0.2, sz=(20, 16)), Brightness()],
+                                  randomize_transforms=True, fuse=fuse)
+        np.random.seed(0)
+        for _ in range(50):
+            assert transformer(batch).shape == (3, 16, 20, 3)
@@ -0,0 +1,61 @@
+import multiprocessing
+import numpy as np
+from aug_transforms import Horizontal_flip, Rotate_rand, Brightness, Crop_and_resize
+from ImageReader import ImageReader
+from DataLoader import DataLoader
+
+def make_reader(image_dir):
+    # a list gives, for each transformation, whether it is always applied: the final resize always is
+    return ImageReader(image_dir, transforms=[Horizontal_flip(), Rotate_rand(15), Brightness(0.2),
+                                              Crop_and_resize(0.8, sz=(32, 24))],
+                       randomize_transforms=[False, False, False, True])
+
+def read_epochs(loader, num_epochs=2):
+    # batches from a shared ring are only valid until the next one, so copy them
+    return [[np.array(batch) for batch in loader] for _ in range(num_epochs)]
+
+def test_plans_replay_across_backends(image_dir):
+    reader = make_reader(image_dir)
+    epochs = read_epochs(DataLoader(reader, batch_size=5, num_workers=3, seed=11))
+    assert len(epochs[0]) == 3 and epochs[0][0].shape == (5, 24, 32, 3)
+    assert any((a != b).any() for a, b in zip(epochs[0], epochs[1]))
+    for backend in ['thread', 'process']:
+        for ordered in [True, False]:
+            loader = DataLoader(reader, batch_size=5, num_workers=3, backend=backend, ordered=ordered, seed=11)
+            other = read_epochs(loader)
+            for batches, expected in zip(other, epochs):
+                if not ordered:
+                    # batches arrive in any order: compare them as a set
+                    key = lambda batch: batch.tobytes()
+                    batches, expected = sorted(batches, key=key), sorted(expected, key=key)
+                for a, b in zip(batches, expected):
+                    np.testing.assert_array_equal(a, b)
+    loader = DataLoader(reader, batch_size=5, num_workers=3, seed=11)
+    read_epochs(loader, 1)
+    assert loader.plan is not None and len(loader.plan) == reader.len
+
+def test_shared_ring_recycles_slots(image_dir):
+    reader = make_reader(image_dir)
+    expected = read_epochs(DataLoader(reader, batch_size=2, num_workers=2, prefetch=2, seed=3))
+    loader = DataLoader(reader, batch_size=2, num_workers=2, backend='process', prefetch=2, seed=3, shared_memory=True)
+    for epoch in range(2):
+        slots = []
+        for batch, other in zip(loader, expected[epoch]):
+            ring = loader.ring
+            slots.append(next(i for i in range(len(ring)) if np.shares_memory(batch, ring.slot(i))))
+            np.testing.assert_array_equal(batch, other)
+        # 6 batches went through the 3 slots of the ring
+        assert len(ring) == 3 and len(slots) == 6 and set(slots) == {0, 1, 2}
+        assert all(a != b for a, b in zip(slots, slots[1:]))
+        assert not multiprocessing.active_children()
+    assert loader.epoch == 2 and loader.ring is ring
+    loader.close()
+    assert loader.ring is None
+
+def test_early_exit_shuts_down(image_dir):
+    loader = DataLoader(make_reader(image_dir), batch_size=2, num_workers=2, backend='process', prefetch=2,
+                        seed=0, shared_memory=True)
+    for batch in loader:
+        break
+    assert not multiprocessing.active_children()
+    loader.close()
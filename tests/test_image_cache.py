@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from ImageCache import ImageCache
+
+def make_image(value, size=10):
+    return np.full((size, size, 3), value, dtype=np.uint8)
+
+def test_evicts_least_recently_used():
+    cache = ImageCache(max_bytes=3 * 300)
+    for key in 'abc':
+        cache.put(key, make_image(ord(key)))
+    assert cache.get('a') is not None  # 'b' is now the least recently used
+    cache.put('d', make_image(1))
+    assert 'b' not in cache and all(key in cache for key in 'acd')
+    assert cache.nbytes == 900 and cache.stats()['evictions'] == 1
+    assert cache.get('b') is None and cache.stats()['misses'] == 1
+
+def test_oversized_images_are_not_cached():
+    cache = ImageCache(max_bytes=100)
+    img = cache.put('a', make_image(0))
+    assert 'a' not in cache and cache.nbytes == 0
+    assert not img.flags.writeable
+
+def test_cached_images_are_read_only():
+    cache = ImageCache(max_bytes=10**6)
+    cache.put('a', make_image(5))
+    img = cache.get('a')
+    with pytest.raises(ValueError):
+        img[0, 0, 0] = 1
+    # replacing an entry keeps the byte count right
+    cache.put('a', make_image(6, size=20))
+    assert cache.nbytes == 1200 and cache.get('a')[0, 0, 0] == 6
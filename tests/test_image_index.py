@@ -0,0 +1,27 @@
+import os
+import numpy as np
+from ImageIndex import ImageIndex
+from conftest import write_images
+
+def test_incremental_rescan(image_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.npz')
+    index = ImageIndex(image_dir, manifest=manifest)
+    assert len(index) == 12 and os.path.isfile(manifest)
+    assert (index.heights == 40 + 7 * np.arange(12)).all() and (index.widths == 60 + 5 * np.arange(12)).all()
+    # nothing changed: the manifest is used as is
+    again = ImageIndex(image_dir, manifest=manifest)
+    assert again.update() == 0
+    np.testing.assert_array_equal(again.ids, index.ids)
+    np.testing.assert_array_equal(again.sizes, index.sizes)
+    # one new image in a new subdirectory: only its header is read
+    write_images(os.path.join(image_dir, 'sub'), n=1, seed=1)
+    assert again.update() == 1
+    assert len(again) == 13 and os.path.join('sub', 'img_00') in again.ids
+    assert ImageIndex(image_dir, manifest=manifest).update() == 0
+
+def test_removed_files_leave_the_index(image_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.npz')
+    ImageIndex(image_dir, manifest=manifest)
+    os.remove(os.path.join(image_dir, 'img_05.png'))
+    index = ImageIndex(image_dir, manifest=manifest)
+    assert len(index) == 11 and 'img_05' not in index.ids
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+from OutputFormat import OutputFormat
+
+MEAN, STD = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+
+def reference(img, dtype, mean, std, scale, layout, bgr):
+    value = (img[:, :, ::-1] if bgr else img) * scale
+    value = (value - np.asarray(mean)) / np.asarray(std)
+    if dtype == np.uint8:
+        value = np.clip(np.rint(value), 0, 255)
+    value = value.astype(dtype)
+    return value.transpose(2, 0, 1) if layout == 'CHW' else value
+
+@pytest.mark.parametrize('layout', ['HWC', 'CHW'])
+@pytest.mark.parametrize('bgr', [False, True])
+@pytest.mark.parametrize('dtype, mean, std, scale', [(np.float32, MEAN, STD, 1 / 255), (np.float16, 0.5, 0.25, 1 / 255),
+                                                     (np.uint8, (10, 20, 30), 1, 1)])
+def test_values(layout, bgr, dtype, mean, std, scale):
+    img = np.random.default_rng(0).integers(0, 256, (17, 23, 3), dtype=np.uint8)
+    fmt = OutputFormat(dtype, mean=mean, std=std, layout=layout)
+    expected = reference(img, dtype, mean, std, scale, layout, bgr)
+    out = fmt(img, bgr=bgr)
+    assert out.dtype == dtype and out.shape == fmt.get_shape(img.shape) == expected.shape
+    np.testing.assert_allclose(out.astype(np.float64), expected.astype(np.float64), rtol=1e-3, atol=1e-3)
+    # into a preallocated output, with the buffers reused
+    np.testing.assert_array_equal(fmt(img, out=np.empty_like(out), bgr=bgr), out)
+
+def test_rejects_wrong_output():
+    fmt = OutputFormat(np.float32, layout='CHW')
+    with pytest.raises(ValueError):
+        fmt(np.zeros((4, 5, 3), dtype=np.uint8), out=np.empty((4, 5, 3), dtype=np.float32))
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from Shard import Shard
+
+def get_partitions(world_size, epoch, num_files, **kwargs):
+    sizes = kwargs.pop('sizes', None)
+    locality = kwargs.pop('locality', None)
+    return [Shard(rank, world_size, **kwargs).get_indices(epoch, num_files, sizes=sizes, locality=locality)
+            for rank in range(world_size)]
+
+def assert_partition(parts, num_files):
+    everything = np.concatenate(parts)
+    assert len(everything) == len(set(everything.tolist())) == num_files
+    assert set(everything.tolist()) == set(range(num_files))
+
+@pytest.mark.parametrize('world_size', [1, 3, 4])
+@pytest.mark.parametrize('num_files', [0, 1, 10, 101])
+def test_count_partitions(world_size, num_files):
+    for epoch in range(3):
+        parts = get_partitions(world_size, epoch, num_files, seed=5)
+        assert_partition(parts, num_files)
+        assert max(map(len, parts)) - min(map(len, parts)) <= 1
+    assert all((a == b).all() for a, b in zip(get_partitions(world_size, 1, num_files, seed=5),
+                                              get_partitions(world_size, 1, num_files, seed=5)))
+
+def test_count_partitions_drop_last():
+    parts = get_partitions(4, 0, 103, drop_last=True)
+    assert all(len(p) == 25 for p in parts) and len(set(np.concatenate(parts).tolist())) == 100
+
+def test_bytes_partitions():
+    sizes = np.random.default_rng(0).integers(1000, 100000, 200)
+    parts = get_partitions(4, 2, 200, balance='bytes', sizes=sizes)
+    assert_partition(parts, 200)
+    loads = [sizes[p].sum() for p in parts]
+    assert max(loads) - min(loads) <= 2 * sizes.max()
+
+def test_locality_partitions():
+    rng = np.random.default_rng(1)
+    locality = rng.integers(-1, 4, 150)
+    for balance, sizes in [('count', None), ('bytes', rng.integers(1000, 5000, 150))]:
+        parts = get_partitions(4, 0, 150, balance=balance, sizes=sizes, locality=locality)
+        assert_partition(parts, 150)
+        # most files land on their preferred rank
+        local = sum((locality[p] == rank).sum() for rank, p in enumerate(parts))
+        assert local >= 0.6 * (locality >= 0).sum()
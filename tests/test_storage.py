@@ -0,0 +1,38 @@
+import cv2
+import numpy as np
+from ImageReader import ImageReader
+from PackedDataset import pack_images, is_packed
+from TiledPyramid import pack_pyramid, is_pyramid
+
+def test_packed_dataset_round_trip(image_dir, tmp_path):
+    reader = ImageReader(image_dir)
+    out_dir = str(tmp_path / 'packed')
+    packed = pack_images(reader, out_dir)
+    assert is_packed(out_dir) and len(packed) == reader.len
+    for i, ID in enumerate(reader.file_ids):
+        img = reader.decode_image(ID)
+        np.testing.assert_array_equal(packed.get(ID), img)
+        np.testing.assert_array_equal(packed[i], img)
+    # a packed directory can be read like the original one
+    packed_reader = ImageReader(out_dir)
+    np.testing.assert_array_equal(packed_reader.decode_image(reader.file_ids[3]), reader.decode_image(reader.file_ids[3]))
+
+def test_packed_dataset_resize(image_dir, tmp_path):
+    packed = pack_images(ImageReader(image_dir), str(tmp_path / 'packed'), sz=(32, 24))
+    assert all(packed[i].shape == (24, 32, 3) for i in range(len(packed)))
+
+def test_tiled_pyramid_round_trip(image_dir, tmp_path):
+    reader = ImageReader(image_dir)
+    out_dir = str(tmp_path / 'pyramid')
+    pyramid = pack_pyramid(reader, out_dir, tile_size=16)
+    assert is_pyramid(out_dir) and len(pyramid) == reader.len
+    for ID in reader.file_ids:
+        img = reader.decode_image(ID)
+        assert pyramid.get_shape(ID) == img.shape
+        np.testing.assert_array_equal(pyramid.get(ID), img)
+        # a region crossing tile borders, at full resolution and one level down
+        np.testing.assert_array_equal(pyramid.read_region(ID, 0, (5, 37, 9, 50)), img[5:37, 9:50])
+        level = pyramid.get_levels(ID)[1]
+        half = cv2.resize(img, (int(level['width']), int(level['height'])), interpolation=cv2.INTER_AREA)
+        np.testing.assert_array_equal(pyramid.read_region(ID, 1, (3, 19, 2, 29)), half[3:19, 2:29])
+    assert ImageReader(out_dir).decode_image(reader.file_ids[0]).shape == reader.decode_image(reader.file_ids[0]).shape
@@ -0,0 +1,29 @@
+import numpy as np
+from aug_transforms import Horizontal_flip, Vertical_flip, Crop_and_resize, Brightness, Contrast, Color_jitter
+from Transformer import Transformer, make_sample_image
+
+def make_transforms():
+    return [Horizontal_flip(), Vertical_flip(), Crop_and_resize(crop_box=(8, 72, 16, 112), sz=(48, 32), do_crop=True),
+            Brightness(0.2), Contrast(0.2)]
+
+def test_fused_matches_unfused():
+    img = make_sample_image((96, 128))
+    fused = Transformer(make_transforms())
+    unfused = Transformer(make_transforms(), fuse=False)
+    assert len(fused.stages) < len(unfused.stages)
+    plan = fused.make_plan(20, np.random.default_rng(0))
+    for params in plan:
+        a, b = fused.apply_plan(img, params), unfused.apply_plan(img, params)
+        assert a.shape == b.shape == (32, 48, 3)
+        # flips and a whole pixel crop with a 2x area resize are exact, lookup tables compose exactly
+        np.testing.assert_array_equal(a, b)
+
+def test_epoch_plan_is_reproducible():
+    transformer = Transformer(make_transforms() + [Color_jitter()], randomize_transforms=True)
+    a = transformer.make_epoch_plan(50, 7, num_streams=4)
+    b = transformer.make_epoch_plan(50, np.random.SeedSequence(7), num_streams=4)
+    assert a.tobytes() == b.tobytes()
+    assert transformer.make_epoch_plan(50, 8, num_streams=4).tobytes() != a.tobytes()
+    img = make_sample_image((96, 128))
+    for params in a[:10]:
+        np.testing.assert_array_equal(transformer.apply_plan(img, params), transformer.apply_plan(img, params))